@@ -1,5 +1,8 @@
 from . import bringdb
 from . import constants
 from . import exceptions
+from . import feedparse
+from . import feedtree
 from . import helpers
+from . import hostlimiter
 from . import objects
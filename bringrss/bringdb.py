@@ -1,29 +1,33 @@
-import bs4
-import random
+import collections
+import re
 import sqlite3
+import threading
 import typing
 
 from . import constants
 from . import exceptions
+from . import feedparse
+from . import feedtree
 from . import helpers
 from . import objects
 
 from voussoirkit import cacheclass
 from voussoirkit import pathclass
-from voussoirkit import sentinel
 from voussoirkit import sqlhelpers
 from voussoirkit import vlogging
 from voussoirkit import worms
 
 log = vlogging.get_logger(__name__)
 
-RNG = random.SystemRandom()
-
 ####################################################################################################
 
 class BDBFeedMixin:
     def __init__(self):
         super().__init__()
+        # See get_feed_tree.
+        self._feed_tree = None
+        self._pending_feed_tree = None
+        self._feed_tree_lock = threading.RLock()
 
     @worms.atomic
     def add_feed(
@@ -78,50 +82,96 @@ class BDBFeedMixin:
             'isolate_guids': isolate_guids,
             'icon': icon,
             'ui_order_rank': ui_order_rank,
+            'http_etag': None,
+            'http_last_modified': None,
+            'last_content_hash': None,
+            'refresh_not_before': None,
+            'refresh_failures': 0,
+            'adaptive_refresh': False,
+            'adaptive_interval_min': None,
+            'adaptive_interval_max': None,
+            'adaptive_interval': None,
+            'high_water_guids': None,
+            'last_full_ingest': None,
         }
         self.insert(table=objects.Feed, pairs=data)
+        self.get_feed_tree().add(data['id'], parent_id, ui_order_rank)
         feed = self.get_cached_instance(objects.Feed, data)
         return feed
 
-    def get_bulk_unread_counts(self):
+    def _adjust_unread_counts(self, deltas:dict):
         '''
-        Instead of calling feed.get_unread_count() on many separate feed objects
-        and performing lots of duplicate work, you can call here and get them
-        all at once with much less database access. I brought my /feeds.json
-        down from 160ms to 6ms by using this.
+        Add to the stored unread counters of some feeds. This must be called by
+        everything that changes whether a news counts as unread or which feed
+        it belongs to.
 
-        Missing keys means 0 unread.
+        deltas:
+            {feed id: change in the number of unread news}
         '''
-        # Even though we have api functions for all of this, I want to squeeze
-        # out the perf. This function is meant to be used in situations where
-        # speed matters more than code beauty.
-        feeds = {feed.id: feed for feed in self.get_feeds()}
-        childs = {}
-        for feed in feeds.values():
-            if feed.parent_id:
-                childs.setdefault(feed.parent_id, []).append(feed)
-        roots = [feed for feed in feeds.values() if not feed.parent_id]
-
+        self.assert_transaction_active()
         query = '''
-        SELECT feed_id, COUNT(rowid)
-        FROM news
-        WHERE recycled == 0 AND read == 0
-        GROUP BY feed_id
+        INSERT INTO feed_unread_counts(feed_id, unread) VALUES(?, ?)
+        ON CONFLICT(feed_id) DO UPDATE SET unread = unread + excluded.unread
+        '''
+        for (feed_id, delta) in deltas.items():
+            if delta == 0:
+                continue
+            self.execute(query, [feed_id, delta])
+
+    @worms.atomic
+    def clear_ingest_caches(self, feeds):
+        '''
+        Forget the content hashes and high water marks of the given feeds, so
+        that the next document each one downloads is parsed and ingested in
+        full even if it hasn't changed. The HTTP validators are kept, but
+        Feed.fetch doesn't send them while the content hash is missing, so
+        the next request is unconditional and can't be answered with 304.
+        The response brings new validators for the requests after that.
+
+        This is needed after changing any setting that would cause the same
+        document to be ingested differently. It's done with a single query, so
+        it's fine to pass a lot of feeds.
+        '''
+        feeds = [feed for feed in feeds if not feed.deleted]
+        if not feeds:
+            return
+
+        query = f'''
+        UPDATE feeds SET last_content_hash = NULL, high_water_guids = NULL, last_full_ingest = NULL
+        WHERE id IN {sqlhelpers.listify(feed.id for feed in feeds)}
+        '''
+        self.execute(query)
+        for feed in feeds:
+            feed.last_content_hash = None
+            feed.high_water_guids = None
+            feed.last_full_ingest = None
+
+    def get_bulk_unread_counts(self):
+        '''
+        Return {feed: unread count} for every feed, where each folder's count
+        includes all of its descendants. Instead of calling
+        feed.get_unread_count() on many separate feed objects and adding up the
+        same subtrees over and over, you can call here and get them all at once.
+
+        The counts come from the stored counters and the feed tree, so this
+        does not touch the news table.
         '''
-        counts = {feeds[feed_id]: count for (feed_id, count) in self.select(query)}
+        feed_tree = self.get_feed_tree()
+        own_counts = self.get_feed_unread_counts()
+        counts = {}
 
-        def recursive_update(feed):
-            counts.setdefault(feed, 0)
-            children = childs.get(feed.id, None)
-            if children:
-                counts[feed] += sum(recursive_update(child) for child in children)
-                pass
-            return counts[feed]
+        def recursive_update(feed_id):
+            count = own_counts.get(feed_id, 0)
+            for child_id in feed_tree.get_children(feed_id):
+                count += recursive_update(child_id)
+            counts[feed_id] = count
+            return count
 
-        for root in roots:
-            recursive_update(root)
+        for root_id in feed_tree.get_children(None):
+            recursive_update(root_id)
 
-        return counts
+        feeds = self.get_feeds_by_id(list(counts))
+        return {feed: counts[feed.id] for feed in feeds}
 
     def get_feed(self, id) -> objects.Feed:
         return self.get_object_by_id(objects.Feed, id)
@@ -129,6 +179,45 @@ class BDBFeedMixin:
     def get_feed_count(self) -> int:
         return self.select_one_value('SELECT COUNT(id) FROM feeds')
 
+    def get_feed_tree(self) -> feedtree.FeedTree:
+        '''
+        Return the FeedTree of all feeds, which is built with a single query the
+        first time it is needed and then kept up to date by add_feed,
+        Feed.set_parent, Feed.set_ui_order_rank, and Feed.delete.
+
+        The thread that owns the transaction gets its own tree, built from its
+        own connection, and that is the one the changes are made to. It
+        replaces the shared tree when the transaction commits, and is thrown
+        away if it rolls back, so the other threads only ever see committed
+        feeds.
+
+        Like the object caches, it does not know about changes made by other
+        processes.
+        '''
+        with self._feed_tree_lock:
+            if self._worms_transaction_owner == threading.current_thread().ident:
+                if self._pending_feed_tree is None:
+                    self._pending_feed_tree = self._load_feed_tree()
+                return self._pending_feed_tree
+
+            if self._feed_tree is None:
+                self._feed_tree = self._load_feed_tree()
+            return self._feed_tree
+
+    def get_feed_unread_counts(self) -> dict:
+        '''
+        Return {feed id: number of unread news in that feed}, not including the
+        feed's descendants. Missing keys means 0 unread.
+
+        The counters are stored in the feed_unread_counts table, which has one
+        small row per feed, so it is read fresh every time. That way we see the
+        counts as of our own transaction or the latest commit, including news
+        added by other processes. If the counters are ever wrong, see
+        verify_unread_counts and rebuild_unread_counts.
+        '''
+        query = 'SELECT feed_id, unread FROM feed_unread_counts'
+        return dict(self.select(query))
+
     def get_feeds(self) -> typing.Iterable[objects.Feed]:
         query = 'SELECT * FROM feeds ORDER BY ui_order_rank ASC'
         return self.get_objects_by_sql(objects.Feed, query)
@@ -136,9 +225,26 @@ class BDBFeedMixin:
     def get_feeds_by_id(self, ids) -> typing.Iterable[objects.Feed]:
         return self.get_objects_by_id(objects.Feed, ids)
 
+    def get_feeds_by_id_ordered(self, ids) -> list:
+        '''
+        Like get_feeds_by_id, but the feeds are returned in the order of ids.
+        IDs that don't exist are skipped, because the feed tree they usually
+        come from can be a moment behind a commit that deleted a feed.
+        '''
+        ids = list(ids)
+        feeds = {feed.id: feed for feed in self.get_feeds_by_id(ids)}
+        return [feeds[id] for id in ids if id in feeds]
+
     def get_feeds_by_sql(self, query, bindings=None) -> typing.Iterable[objects.Feed]:
         return self.get_objects_by_sql(objects.Feed, query, bindings)
 
+    def get_feeds_sharing_guids(self) -> typing.Iterable[objects.Feed]:
+        '''
+        Return the feeds that don't isolate their guids, which are the ones
+        whose news can be skipped as duplicates of each other's.
+        '''
+        return self.get_feeds_by_sql('SELECT * FROM feeds WHERE isolate_guids == 0')
+
     def get_last_ui_order_rank(self) -> int:
         query = 'SELECT ui_order_rank FROM feeds ORDER BY ui_order_rank DESC LIMIT 1'
         rank = self.select_one_value(query)
@@ -147,8 +253,11 @@ class BDBFeedMixin:
         return rank
 
     def get_root_feeds(self) -> typing.Iterable[objects.Feed]:
-        query = 'SELECT * FROM feeds WHERE parent_id IS NULL ORDER BY ui_order_rank ASC'
-        return self.get_objects_by_sql(objects.Feed, query)
+        return self.get_feeds_by_id_ordered(self.get_feed_tree().get_children(None))
+
+    def _load_feed_tree(self) -> feedtree.FeedTree:
+        query = 'SELECT id, parent_id, ui_order_rank FROM feeds'
+        return feedtree.FeedTree(self.select(query))
 
     @worms.atomic
     def reassign_ui_order_ranks(self):
@@ -159,6 +268,95 @@ class BDBFeedMixin:
                 descendant.set_ui_order_rank(rank)
                 rank += 1
 
+    @worms.atomic
+    def rebuild_unread_counts(self):
+        '''
+        Recount the unread news of every feed from scratch and overwrite the
+        stored counters.
+        '''
+        log.info('Rebuilding unread counts.')
+        self.execute('DELETE FROM feed_unread_counts')
+        query = '''
+        INSERT INTO feed_unread_counts(feed_id, unread)
+        SELECT feed_id, COUNT(rowid)
+        FROM news
+        WHERE recycled == 0 AND read == 0
+        GROUP BY feed_id
+        '''
+        self.execute(query)
+
+    @worms.atomic
+    def update_adaptive_intervals(self, feeds=None) -> list:
+        '''
+        Predict how often each feed publishes, using the news it published
+        within constants.ADAPTIVE_LOOKBACK, and store the result as the feed's
+        adaptive_interval. Only feeds with adaptive_refresh enabled are
+        updated. This is done for all of them with one query on the
+        original_feed_id_published index, so call it after a batch of
+        refreshes rather than after each one.
+
+        feeds:
+            Update only these feeds instead of all feeds.
+
+        Returns the list of feeds whose adaptive_interval changed, so that the
+        caller can reschedule them.
+        '''
+        if feeds is None:
+            feeds = self.get_feeds()
+        feeds = [feed for feed in feeds if feed.adaptive_refresh and not feed.deleted]
+        if not feeds:
+            return []
+
+        now = helpers.now()
+        query = f'''
+        SELECT original_feed_id, COUNT(rowid), MIN(published)
+        FROM news
+        WHERE original_feed_id IN {sqlhelpers.listify(feed.id for feed in feeds)} AND published > ?
+        GROUP BY original_feed_id
+        '''
+        history = {
+            feed_id: (count, oldest)
+            for (feed_id, count, oldest) in self.select(query, [now - constants.ADAPTIVE_LOOKBACK])
+        }
+
+        changed = []
+        for feed in feeds:
+            (count, oldest) = history.get(feed.id, (0, None))
+            interval = feed.predict_adaptive_interval(count=count, oldest=oldest, now=now)
+            if interval != feed.adaptive_interval:
+                feed._set_adaptive_interval(interval)
+                changed.append(feed)
+
+        return changed
+
+    def verify_unread_counts(self) -> list:
+        '''
+        Compare the stored unread counters against an actual count of the news
+        table. Returns a list of dicts with the feed_id and the stored and
+        actual counts of every feed where they differ, so an empty list means
+        the counters are correct.
+        '''
+        query = '''
+        SELECT feed_id, COUNT(rowid)
+        FROM news
+        WHERE recycled == 0 AND read == 0
+        GROUP BY feed_id
+        '''
+        actual = dict(self.select(query))
+        stored = self.get_feed_unread_counts()
+
+        mismatches = []
+        for feed_id in sorted(set(actual).union(stored)):
+            counts = {
+                'feed_id': feed_id,
+                'stored': stored.get(feed_id, 0),
+                'actual': actual.get(feed_id, 0),
+            }
+            if counts['stored'] == counts['actual']:
+                continue
+            mismatches.append(counts)
+        return mismatches
+
 ####################################################################################################
 
 class BDBFilterMixin:
@@ -200,39 +398,50 @@ class BDBFilterMixin:
 
     @worms.atomic
     def process_news_through_filters(self, news):
+        self.process_newss_through_filters([news])
+
+    @worms.atomic
+    def process_newss_through_filters(self, newss):
+        '''
+        Run each news through the filters of its feed and the feed's ancestors.
+        The filter list of each feed is gathered once for the whole batch.
+        '''
+        feed_filters = {}
         def prepare_filters(feed):
-            filters = []
-            for ancestor in feed.walk_parents(yield_self=True):
-                filters.extend(ancestor.get_filters())
-            return filters
-
-        feed = news.feed
-        original_feed = feed
-        filters = prepare_filters(feed)
-        status = objects.Filter.THEN_CONTINUE_FILTERS
-        too_many_switches = 20
-
-        while feed and filters and status is objects.Filter.THEN_CONTINUE_FILTERS:
-            filt = filters.pop(0)
-            status = filt.process_news(news)
-
-            switched_feed = news.feed
-            if switched_feed == feed:
-                continue
+            filters = feed_filters.get(feed)
+            if filters is None:
+                filters = []
+                for ancestor in feed.walk_parents(yield_self=True):
+                    filters.extend(ancestor.get_filters())
+                feed_filters[feed] = filters
+            return filters.copy()
 
-            feed = switched_feed
+        for news in newss:
+            feed = news.feed
+            original_feed = feed
             filters = prepare_filters(feed)
+            status = objects.Filter.THEN_CONTINUE_FILTERS
+            too_many_switches = 20
 
-            too_many_switches -= 1
-            if too_many_switches > 0:
-                continue
-            raise Exception(f'{news} from {original_feed} got moved too many times. Something wrong?')
+            while feed and filters and status is objects.Filter.THEN_CONTINUE_FILTERS:
+                filt = filters.pop(0)
+                status = filt.process_news(news)
+
+                switched_feed = news.feed
+                if switched_feed == feed:
+                    continue
+
+                feed = switched_feed
+                filters = prepare_filters(feed)
+
+                too_many_switches -= 1
+                if too_many_switches > 0:
+                    continue
+                raise Exception(f'{news} from {original_feed} got moved too many times. Something wrong?')
 
 ####################################################################################################
 
 class BDBNewsMixin:
-    DUPLICATE_BAIL = sentinel.Sentinel('duplicate bail')
-
     def __init__(self):
         super().__init__()
 
@@ -251,43 +460,273 @@ class BDBNewsMixin:
             updated,
             web_url,
         ):
-        if not isinstance(feed, objects.Feed):
-            raise TypeError(feed)
-        feed.assert_not_deleted()
-
-        rss_guid = objects.News.normalize_rss_guid(rss_guid)
-        if feed.isolate_guids:
-            rss_guid = f'_isolate_{feed.id}_{rss_guid}'
-
-        published = objects.News.normalize_published(published)
-        updated = objects.News.normalize_updated(updated)
-        title = objects.News.normalize_title(title)
-        text = objects.News.normalize_text(text)
-        web_url = objects.News.normalize_web_url(web_url)
-        comments_url = objects.News.normalize_comments_url(comments_url)
-        authors = objects.News.normalize_authors_json(authors)
-        enclosures = objects.News.normalize_enclosures_json(enclosures)
-
-        data = {
-            'id': self.generate_id(objects.News),
-            'feed_id': feed.id,
-            'original_feed_id': feed.id,
-            'rss_guid': rss_guid,
+        news = {
+            'authors': authors,
+            'comments_url': comments_url,
+            'enclosures': enclosures,
+            'feed': feed,
             'published': published,
-            'updated': updated,
-            'title': title,
+            'rss_guid': rss_guid,
             'text': text,
+            'title': title,
+            'updated': updated,
             'web_url': web_url,
-            'comments_url': comments_url,
-            'created': helpers.now(),
-            'read': False,
-            'recycled': False,
-            'authors': authors,
-            'enclosures': enclosures,
         }
-        self.insert(table=objects.News, pairs=data)
-        news = self.get_cached_instance(objects.News, data)
-        return news
+        return self.add_newss([news])[0]
+
+    @worms.atomic
+    def add_newss(self, newss) -> list:
+        '''
+        Add many news at once. Each item of newss is a dict of the same keyword
+        arguments that add_news takes. The ids are allocated in bulk and the
+        rows are inserted with one executemany, which is much faster than
+        calling add_news in a loop when ingesting a big feed or importing.
+
+        Returns the list of News in the same order.
+        '''
+        created = helpers.now()
+        ids = self.generate_ids(objects.News, len(newss))
+
+        datas = []
+        for (id, news) in zip(ids, newss):
+            feed = news['feed']
+            if not isinstance(feed, objects.Feed):
+                raise TypeError(feed)
+            feed.assert_not_deleted()
+
+            rss_guid = objects.News.normalize_rss_guid(news['rss_guid'])
+            if feed.isolate_guids:
+                rss_guid = f'_isolate_{feed.id}_{rss_guid}'
+
+            data = {
+                'id': id,
+                'feed_id': feed.id,
+                'original_feed_id': feed.id,
+                'rss_guid': rss_guid,
+                'published': objects.News.normalize_published(news['published']),
+                'updated': objects.News.normalize_updated(news['updated']),
+                'title': objects.News.normalize_title(news['title']),
+                'text': objects.News.normalize_text(news['text']),
+                'web_url': objects.News.normalize_web_url(news['web_url']),
+                'comments_url': objects.News.normalize_comments_url(news['comments_url']),
+                'created': created,
+                'read': False,
+                'recycled': False,
+                'authors': objects.News.normalize_authors_json(news['authors']),
+                'enclosures': objects.News.normalize_enclosures_json(news['enclosures']),
+                'guid_hash': helpers.hash_guid(rss_guid),
+            }
+            datas.append(data)
+
+        self.insert_many(table=objects.News, pairss=datas)
+        self._adjust_unread_counts(collections.Counter(data['feed_id'] for data in datas))
+        return [self.get_cached_instance(objects.News, data) for data in datas]
+
+    def check_query_plans(self) -> list:
+        '''
+        Run EXPLAIN QUERY PLAN on the queries behind the news listings, unread
+        counts, adaptive intervals, and duplicate detection, and check that each one is served by
+        the index that was designed for it. This catches changes to the schema
+        or to the queries that would make them scan or sort the whole table.
+
+        Returns a list of dicts with the description, expected index, plan, and
+        whether it was ok.
+        '''
+        def newss_query(**kwargs):
+            return self._get_newss_query(**kwargs)[0]
+
+        one = [1]
+        folder = [1, 2, 3]
+        # (description, query, expected index, whether a temp b-tree is ok)
+        expectations = [
+            (
+                'unread news of a feed',
+                newss_query(read=False, recycled=False, feed_ids=one),
+                'index_news_unread_feed_id_published',
+                False,
+            ),
+            (
+                # Each feed's part of the index is in order, but they have to
+                # be merged.
+                'unread news of a folder',
+                newss_query(read=False, recycled=False, feed_ids=folder),
+                'index_news_unread_feed_id_published',
+                True,
+            ),
+            (
+                'unread news of all feeds',
+                newss_query(read=False, recycled=False, feed_ids=None),
+                'index_news_unread_published',
+                False,
+            ),
+            (
+                'read and unread news of a feed',
+                newss_query(read=None, recycled=False, feed_ids=one),
+                'index_news_feed_id_published',
+                False,
+            ),
+            (
+                'read and unread news of all feeds',
+                newss_query(read=None, recycled=False, feed_ids=None),
+                'index_news_unrecycled_published',
+                False,
+            ),
+            (
+                'recycled news of all feeds',
+                newss_query(read=None, recycled=True, feed_ids=None),
+                'index_news_recycled_published',
+                False,
+            ),
+            (
+                'a later page of unread news of a feed',
+                newss_query(read=False, recycled=False, feed_ids=one, after=(0, 0), limit=100),
+                'index_news_unread_feed_id_published',
+                False,
+            ),
+            (
+                'a later page of read and unread news of a folder',
+                newss_query(read=None, recycled=False, feed_ids=folder, after=(0, 0), limit=100),
+                'index_news_feed_id_published',
+                True,
+            ),
+            (
+                'a later page of unread news of all feeds',
+                newss_query(read=False, recycled=False, feed_ids=None, after=(0, 0), limit=100),
+                'index_news_unread_published',
+                False,
+            ),
+            (
+                'recounting the unread counters',
+                'SELECT feed_id, COUNT(rowid) FROM news WHERE recycled == 0 AND read == 0 GROUP BY feed_id',
+                'index_news_unread_feed_id_published',
+                False,
+            ),
+            (
+                'publish history for adaptive intervals',
+                '''
+                SELECT original_feed_id, COUNT(rowid), MIN(published)
+                FROM news
+                WHERE original_feed_id IN (1, 2, 3) AND published > ?
+                GROUP BY original_feed_id
+                ''',
+                'index_news_original_feed_id_published',
+                False,
+            ),
+            (
+                'existing guids',
+                'SELECT rss_guid FROM news WHERE guid_hash IN (?, ?)',
+                'index_news_guid_hash',
+                False,
+            ),
+        ]
+
+        results = []
+        for (description, query, index, temp_ok) in expectations:
+            bindings = [None] * query.count('?')
+            plan = self.explain(query, bindings)
+            ok = re.search(rf'INDEX {index}\b', plan) is not None
+            if 'TEMP B-TREE' in plan and not temp_ok:
+                ok = False
+            results.append({
+                'description': description,
+                'expected': index,
+                'plan': plan,
+                'ok': ok,
+            })
+            if not ok:
+                log.warning('Unexpected query plan for %s:\n%s', description, plan)
+
+        return results
+
+    def entry_guid(self, kind, entry:dict, feed) -> str:
+        '''
+        Return the rss_guid that this feedparse entry record would get as a
+        news of the given feed, not including the isolation prefix. Raises
+        exceptions.NoGUID if there isn't one.
+        '''
+        if kind == 'rss':
+            return self._prepare_news_rss(entry, feed)['rss_guid']
+        elif kind == 'atom':
+            return self._prepare_news_atom(entry, feed)['rss_guid']
+        else:
+            raise exceptions.NeitherAtomNorRSS(kind)
+
+    def _finish_news_atom(self, entry:dict, news:dict):
+        text = entry['content']
+        if text is not None:
+            text = text.strip()
+
+        comments_url = None
+
+        authors = [author.copy() for author in entry['authors']]
+
+        enclosures = []
+        for raw_enclosure in entry['enclosures']:
+            enclosure = {
+                'type': raw_enclosure.get('type', None),
+                'url': raw_enclosure.get('href', None),
+                'size': raw_enclosure.get('length', None),
+            }
+            if enclosure.get('size') is not None:
+                enclosure['size'] = int(enclosure['size'])
+
+            enclosures.append(enclosure)
+
+        news.update(
+            authors=authors,
+            comments_url=comments_url,
+            enclosures=enclosures,
+            text=text,
+        )
+
+    def _finish_news_rss(self, item:dict, news:dict):
+        comments_url = item['comments']
+
+        authors = []
+        for author in item['authors']:
+            author = author.strip()
+            if author:
+                author = {
+                    'name': author,
+                }
+                authors.append(author)
+
+        enclosures = []
+        for raw_enclosure in item['enclosures']:
+            enclosure = {
+                'type': raw_enclosure.get('type', None),
+                'url': raw_enclosure.get('url', None),
+                'size': raw_enclosure.get('length', None),
+            }
+
+            if enclosure.get('size') is not None:
+                enclosure['size'] = int(enclosure['size'])
+
+            enclosures.append(enclosure)
+
+        news.update(
+            authors=authors,
+            comments_url=comments_url,
+            enclosures=enclosures,
+        )
+
+    def _get_existing_guids(self, guids) -> set:
+        '''
+        Given rss_guids as they are stored in the database, with the isolation
+        prefix if any, return the set of those which already exist. This looks
+        up the guid hashes in batches, without loading any News.
+        '''
+        guids = set(guids)
+        hashes = list({helpers.hash_guid(guid) for guid in guids})
+        matches = set()
+        for index in range(0, len(hashes), constants.SQL_MAX_VARIABLES):
+            batch = hashes[index:index + constants.SQL_MAX_VARIABLES]
+            qmarks = ', '.join('?' * len(batch))
+            query = f'SELECT rss_guid FROM news WHERE guid_hash IN ({qmarks})'
+            matches.update(self.select_column(query, batch))
+
+        # A hash match could be a collision with a different guid.
+        return guids.intersection(matches)
 
     def get_news(self, id) -> objects.News:
         return self.get_object_by_id(objects.News, id)
@@ -301,16 +740,116 @@ class BDBNewsMixin:
             read=False,
             recycled=False,
             feed=None,
+            limit=None,
+            after=None,
         ) -> typing.Iterable[objects.News]:
+        '''
+        Yield the news of the given feed and its descendants, or of all feeds,
+        newest first.
 
-        if feed is not None and not isinstance(feed, objects.Feed):
-            feed = self.get_feed(feed)
+        read, recycled:
+            True or False to require that value, None for either.
+
+        limit:
+            Yield at most this many news.
+
+        after:
+            A cursor from News.cursor. Only news that come after that news in
+            this ordering are yielded. Ties on published are broken by id, so
+            a listing can be paged through with limit and the last news's
+            cursor without skipping or repeating any, even while new news are
+            being added.
+        '''
+        (feed_ids, limit, after) = self._normalize_listing_arguments(feed, limit, after)
+        # News.text selects the text when it's needed, so we don't have to read
+        # every news's text just to make the objects.
+        columns = ', '.join(column for column in constants.SQL_COLUMNS['news'] if column != 'text')
+        (query, bindings) = self._get_newss_query(
+            read=read,
+            recycled=recycled,
+            feed_ids=feed_ids,
+            after=after,
+            limit=limit,
+            columns=columns,
+        )
+        rows = self.select(query, bindings)
+        for row in rows:
+            yield self.get_cached_instance(objects.News, row)
+
+    def get_newss_by_id(self, ids) -> typing.Iterable[objects.News]:
+        return self.get_objects_by_id(objects.News, ids)
 
+    def get_newss_by_sql(self, query, bindings=None) -> typing.Iterable[objects.News]:
+        return self.get_objects_by_sql(objects.News, query, bindings)
+
+    def get_newss_json(
+            self,
+            *,
+            read=False,
+            recycled=False,
+            feed=None,
+            limit=None,
+            after=None,
+        ) -> tuple:
+        '''
+        The fast path for the news list of the UI. Takes the same arguments as
+        get_newss, but instead of News objects, returns (json, next_cursor).
+
+        json is the text of a JSON list with a dict per news, which has only
+        the properties that the list needs. The dicts are built by SQLite
+        from the list columns, so the text of the news is never read, and no
+        News objects are made or cached.
+
+        next_cursor is the cursor of the last news if limit was reached, so
+        that it can be passed as `after` to get the next page, or else None.
+
+        See utilities/benchmark_news_listing.py for the difference this makes.
+        '''
+        (feed_ids, limit, after) = self._normalize_listing_arguments(feed, limit, after)
+        # News.published is naive, and astimezone treats a naive datetime as
+        # local time, so News.published_string_local comes out the same as
+        # published_string. Both are given here so that the dicts can stand
+        # in for News.jsonify.
+        columns = '''
+        published,
+        id,
+        json_object(
+            'type', 'news',
+            'id', id,
+            'enclosures', json(COALESCE(enclosures, '[]')),
+            'feed_id', feed_id,
+            'published_unix', published,
+            'published_string', strftime('%Y-%m-%d %H:%M', published, 'unixepoch'),
+            'published_string_local', strftime('%Y-%m-%d %H:%M', published, 'unixepoch'),
+            'read', read,
+            'recycled', recycled,
+            'title', title,
+            'web_url', web_url
+        )
+        '''
+        (query, bindings) = self._get_newss_query(
+            read=read,
+            recycled=recycled,
+            feed_ids=feed_ids,
+            after=after,
+            limit=limit,
+            columns=columns,
+        )
+        rows = self.execute_read(query, bindings).fetchall()
+
+        if limit is not None and len(rows) == limit:
+            next_cursor = objects.News.make_cursor(rows[-1][0], rows[-1][1])
+        else:
+            next_cursor = None
+
+        newss_json = '[' + ','.join(row[2] for row in rows) + ']'
+        return (newss_json, next_cursor)
+
+    def _get_newss_query(self, *, read, recycled, feed_ids, after=None, limit=None, columns='*'):
         wheres = []
         bindings = []
 
-        if feed:
-            feed_ids = [descendant.id for descendant in feed.walk_children()]
+        if feed_ids:
             wheres.append(f'feed_id IN {sqlhelpers.listify(feed_ids)}')
 
         if recycled is True:
@@ -322,61 +861,123 @@ class BDBNewsMixin:
             wheres.append('read == 1')
         elif read is False:
             wheres.append('read == 0')
+
+        if after is not None:
+            # The listing indices end with the implied rowid, so this is a
+            # range on the index and the ORDER BY is still free.
+            wheres.append('(published, id) < (?, ?)')
+            bindings.extend(after)
+
         if wheres:
             wheres = ' AND '.join(wheres)
             wheres = ' WHERE ' + wheres
         else:
             wheres = ''
-        query = 'SELECT * FROM news' + wheres + ' ORDER BY published DESC'
+        query = f'SELECT {columns} FROM news' + wheres + ' ORDER BY published DESC, id DESC'
 
-        rows = self.select(query, bindings)
-        for row in rows:
-            yield self.get_cached_instance(objects.News, row)
+        if limit is not None:
+            query += ' LIMIT ?'
+            bindings.append(limit)
 
-    def get_newss_by_id(self, ids) -> typing.Iterable[objects.News]:
-        return self.get_objects_by_id(objects.News, ids)
+        return (query, bindings)
 
-    def get_newss_by_sql(self, query, bindings=None) -> typing.Iterable[objects.News]:
-        return self.get_objects_by_sql(objects.News, query, bindings)
+    @worms.atomic
+    def ingest_parsed_feed(self, parsed:feedparse.ParsedFeed, feed):
+        '''
+        Add the entries of the ParsedFeed as news of the given feed, skipping
+        the ones that are duplicates, and run the new news through the filters.
+
+        The guids of all entries are figured out first so that the duplicates
+        can be found with a few set-based queries instead of one per entry.
+
+        Returns the list of new news.
+        '''
+        if parsed.kind == 'rss':
+            (prepare, finish) = (self._prepare_news_rss, self._finish_news_rss)
+        elif parsed.kind == 'atom':
+            (prepare, finish) = (self._prepare_news_atom, self._finish_news_atom)
+        else:
+            raise exceptions.NeitherAtomNorRSS(parsed)
+
+        prepared = []
+        for entry in parsed.entries:
+            news = prepare(entry, feed)
+            if feed.isolate_guids:
+                stored_guid = f'_isolate_{feed.id}_{news["rss_guid"]}'
+            else:
+                stored_guid = news['rss_guid']
+            prepared.append((entry, news, stored_guid))
+
+        # The set also catches entries that repeat a guid from earlier in the
+        # same document.
+        seen_guids = self._get_existing_guids(stored_guid for (entry, news, stored_guid) in prepared)
+
+        new_newss = []
+        for (entry, news, stored_guid) in prepared:
+            if stored_guid in seen_guids:
+                log.loud('Skipping duplicate news, feed=%s, guid=%s', feed.id, news['rss_guid'])
+                continue
+            seen_guids.add(stored_guid)
+
+            finish(entry, news)
+            new_newss.append({'feed': feed, **news})
+
+        results = self.add_newss(new_newss)
+        self.process_newss_through_filters(results)
+
+        feed._set_high_water_mark(
+            [(news['rss_guid'], news['published']) for (entry, news, stored_guid) in prepared],
+            complete=parsed.complete,
+        )
+        return results
+
+    def _normalize_listing_arguments(self, feed, limit, after) -> tuple:
+        '''
+        Return the (feed_ids, limit, after) for _get_newss_query from the
+        arguments of get_newss.
+        '''
+        if feed is not None and not isinstance(feed, objects.Feed):
+            feed = self.get_feed(feed)
+
+        if feed:
+            feed_ids = feed.get_subtree_ids()
+        else:
+            feed_ids = None
 
-    def _get_duplicate_news(self, feed, guid):
-        if feed.isolate_guids:
-            guid = f'_isolate_{feed.id}_{guid}'
+        if limit is not None:
+            limit = helpers.normalize_int_or_none(limit)
+            if limit < 1:
+                raise ValueError(f'limit should be at least 1, not {limit}.')
 
-        match = self.select_one('SELECT * FROM news WHERE rss_guid == ?', [guid])
-        if match is None:
-            return None
+        if after is not None:
+            after = objects.News.parse_cursor(after)
 
-        return self.get_cached_instance(objects.News, match)
+        return (feed_ids, limit, after)
 
-    def _ingest_one_news_atom(self, entry, feed):
-        rss_guid = entry.id
+    def _prepare_news_atom(self, entry:dict, feed) -> dict:
+        rss_guid = entry['id']
 
-        web_url = helpers.pick_web_url_atom(entry)
+        web_url = helpers.pick_web_url_atom(entry['links'])
 
-        updated = entry.updated
+        updated = entry['updated']
         if updated is not None:
-            updated = updated.text
-            updated = helpers.dateutil_parse(updated)
-            updated = updated.timestamp()
+            updated = helpers.parse_timestamp(updated)
 
-        published = entry.published
+        published = entry['published']
         if published is not None:
-            published = published.text
-            published = helpers.dateutil_parse(published)
-            published = published.timestamp()
+            published = helpers.parse_timestamp(published)
         elif updated is not None:
             published = updated
 
         if updated is None and published is not None:
             updated = published
 
-        title = entry.find('title')
-        if title:
-            title = title.text.strip()
+        title = entry['title']
+        if title is not None:
+            title = title.strip()
 
-        if rss_guid:
-            rss_guid = rss_guid.text.strip()
+        if rss_guid is not None:
+            rss_guid = rss_guid.strip()
         elif web_url:
             rss_guid = web_url
         elif title:
@@ -387,85 +988,43 @@ class BDBNewsMixin:
         if not rss_guid:
             raise exceptions.NoGUID(entry)
 
-        duplicate = self._get_duplicate_news(feed=feed, guid=rss_guid)
-        if duplicate:
-            log.loud('Skipping duplicate feed=%s, guid=%s', feed.id, rss_guid)
-            return BDBNewsMixin.DUPLICATE_BAIL
-
-        text = entry.find('content')
-        if text:
-            text = text.text.strip()
-
-        comments_url = None
-
-        raw_authors = entry.find_all('author')
-        authors = []
-        for raw_author in raw_authors:
-            author = {
-                'name': raw_author.find('name'),
-                'email': raw_author.find('email'),
-                'uri': raw_author.find('uri'),
-            }
-            author = {key:(value.text if value else None) for (key, value) in author.items()}
-            authors.append(author)
-
-        raw_enclosures = entry.find_all('link', {'rel': 'enclosure'})
-        enclosures = []
-        for raw_enclosure in raw_enclosures:
-            enclosure = {
-                'type': raw_enclosure.get('type', None),
-                'url': raw_enclosure.get('href', None),
-                'size': raw_enclosure.get('length', None),
-            }
-            if enclosure.get('size') is not None:
-                enclosure['size'] = int(enclosure['size'])
-
-            enclosures.append(enclosure)
-
-        news = self.add_news(
-            authors=authors,
-            comments_url=comments_url,
-            enclosures=enclosures,
-            feed=feed,
-            published=published,
-            rss_guid=rss_guid,
-            text=text,
-            title=title,
-            updated=updated,
-            web_url=web_url,
-        )
+        news = {
+            'published': published,
+            'rss_guid': rss_guid,
+            'title': title,
+            'updated': updated,
+            'web_url': web_url,
+        }
         return news
 
-    def _ingest_one_news_rss(self, item, feed):
-        rss_guid = item.find('guid')
+    def _prepare_news_rss(self, item:dict, feed) -> dict:
+        rss_guid = item['guid']
 
-        title = item.find('title')
-        if title:
-            title = title.text.strip()
+        title = item['title']
+        if title is not None:
+            title = title.strip()
 
-        text = item.find('description')
-        if text:
-            text = text.text.strip()
+        text = item['description']
+        if text is not None:
+            text = text.strip()
 
-        web_url = item.find('link')
-        if web_url:
-            web_url = web_url.text.strip()
-        elif rss_guid and rss_guid.get('isPermalink'):
-            web_url = rss_guid.text
+        web_url = item['link']
+        if web_url is not None:
+            web_url = web_url.strip()
+        elif rss_guid is not None and item['guid_is_permalink']:
+            web_url = rss_guid
 
         if web_url and '://' not in web_url:
             web_url = None
 
-        published = item.find('pubDate')
-        if published:
-            published = published.text
-            published = helpers.dateutil_parse(published)
-            published = published.timestamp()
+        published = item['pubDate']
+        if published is not None:
+            published = helpers.parse_timestamp(published)
         else:
             published = 0
 
-        if rss_guid:
-            rss_guid = rss_guid.text.strip()
+        if rss_guid is not None:
+            rss_guid = rss_guid.strip()
         elif web_url:
             rss_guid = web_url
         elif title:
@@ -476,95 +1035,16 @@ class BDBNewsMixin:
         if not rss_guid:
             raise exceptions.NoGUID(item)
 
-        duplicate = self._get_duplicate_news(feed=feed, guid=rss_guid)
-        if duplicate:
-            log.loud('Skipping duplicate news, feed=%s, guid=%s', feed.id, rss_guid)
-            return BDBNewsMixin.DUPLICATE_BAIL
-
-        comments_url = item.find('comments')
-        if comments_url is not None:
-            comments_url = comments_url.text
-
-        raw_authors = item.find_all('author')
-        authors = []
-        for raw_author in raw_authors:
-            author = raw_author.text.strip()
-            if author:
-                author = {
-                    'name': author,
-                }
-                authors.append(author)
-
-        raw_enclosures = item.find_all('enclosure')
-        enclosures = []
-        for raw_enclosure in raw_enclosures:
-            enclosure = {
-                'type': raw_enclosure.get('type', None),
-                'url': raw_enclosure.get('url', None),
-                'size': raw_enclosure.get('length', None),
-            }
-
-            if enclosure.get('size') is not None:
-                enclosure['size'] = int(enclosure['size'])
-
-            enclosures.append(enclosure)
-
-        news = self.add_news(
-            authors=authors,
-            comments_url=comments_url,
-            enclosures=enclosures,
-            feed=feed,
-            published=published,
-            rss_guid=rss_guid,
-            text=text,
-            title=title,
-            updated=published,
-            web_url=web_url,
-        )
+        news = {
+            'published': published,
+            'rss_guid': rss_guid,
+            'text': text,
+            'title': title,
+            'updated': published,
+            'web_url': web_url,
+        }
         return news
 
-    def _ingest_news_atom(self, soup, feed):
-        atom_feed = soup.find('feed')
-
-        if not atom_feed:
-            raise exceptions.BadXML('No feed element.')
-
-        for entry in atom_feed.find_all('entry'):
-            news = self._ingest_one_news_atom(entry, feed)
-            if news is not BDBNewsMixin.DUPLICATE_BAIL:
-                yield news
-
-    def _ingest_news_rss(self, soup, feed):
-        rss = soup.find('rss')
-
-        # This won't happen under normal circumstances since Feed.refresh would
-        # have raised already. But including these checks here in case user
-        # calls directly.
-        if not rss:
-            raise exceptions.BadXML('No rss element.')
-
-        channel = rss.find('channel')
-
-        if not channel:
-            raise exceptions.BadXML('No channel element.')
-
-        for item in channel.find_all('item'):
-            news = self._ingest_one_news_rss(item, feed)
-            if news is not BDBNewsMixin.DUPLICATE_BAIL:
-                yield news
-
-    @worms.atomic
-    def ingest_news_xml(self, soup:bs4.BeautifulSoup, feed):
-        if soup.rss:
-            newss = self._ingest_news_rss(soup, feed)
-        elif soup.feed:
-            newss = self._ingest_news_atom(soup, feed)
-        else:
-            raise exceptions.NeitherAtomNorRSS(soup)
-
-        for news in newss:
-            self.process_news_through_filters(news)
-
 ####################################################################################################
 
 class BringDB(
@@ -596,6 +1076,10 @@ class BringDB(
         '''
         super().__init__()
 
+        # {table: the next id to hand out}, valid only for the duration of the
+        # current transaction. See generate_ids.
+        self._next_ids = {}
+
         # DATA DIR PREP
         if data_directory is not None:
             pass
@@ -657,8 +1141,13 @@ class BringDB(
             raise FileNotFoundError(msg)
 
         self.data_directory.makedirs(exist_ok=True)
-        self.sql_read = self._make_sqlite_read_connection(self.database_filepath)
+        # The write connection goes first because it creates the file, and the
+        # read-only connection can't open a file that doesn't exist yet.
         self.sql_write = self._make_sqlite_write_connection(self.database_filepath)
+        self.sql_read = self._make_sqlite_read_connection(self.database_filepath)
+        # So that queries which rewrite rss_guid can keep guid_hash in sync.
+        for sql in [self.sql_read, self.sql_write]:
+            sql.create_function('hash_guid', 1, helpers.hash_guid, deterministic=True)
 
         if existing_database:
             if not skip_version_check:
@@ -712,16 +1201,91 @@ class BringDB(
     def close(self) -> None:
         super().close()
 
+    def commit(self, message=None) -> None:
+        # The lock is held through the commit so that our feed tree replaces
+        # the shared one before the next transaction can commit its own.
+        with self._feed_tree_lock:
+            try:
+                super().commit(message)
+            finally:
+                self._next_ids.clear()
+            if self._pending_feed_tree is not None:
+                self._feed_tree = self._pending_feed_tree
+                self._pending_feed_tree = None
+
     def generate_id(self, thing_class) -> int:
         '''
         Create a new ID number that is unique to the given table.
         '''
+        return self.generate_ids(thing_class, 1)[0]
+
+    def generate_ids(self, thing_class, count) -> list:
+        '''
+        Create this many new ID numbers that are unique to the given table.
+
+        The IDs count up from the table's high water mark in the id_counters
+        table, which is looked up once per transaction, so there is no query
+        per ID and new rows go to the end of the id index instead of being
+        scattered across it. The mark is raised in the same transaction, so an
+        ID is never handed out twice, even after the row that had it is
+        deleted. Otherwise a deleted feed's ID could be given to a new feed,
+        and open pages, cached responses, and the _isolate_{id}_ guid prefixes
+        would then refer to the wrong one. Databases that already have random
+        IDs keep them, and new IDs continue above the largest one.
+        '''
         if not issubclass(thing_class, objects.ObjectBase):
             raise TypeError(thing_class)
 
+        # The counter is only trustworthy while we hold the transaction, since
+        # other processes can insert as soon as we commit.
+        self.assert_transaction_active()
+
         table = thing_class.table
 
-        while True:
-            id = RNG.getrandbits(32)
-            if not self.exists(f'SELECT 1 FROM {table} WHERE id == ?', [id]):
-                return id
+        next_id = self._next_ids.get(table)
+        if next_id is None:
+            query = 'SELECT last_id FROM id_counters WHERE table_name == ?'
+            last_id = self.select_one_value(query, [table], fallback=0)
+            # In case rows were inserted by something that doesn't use us.
+            max_id = self.select_one_value(f'SELECT MAX(id) FROM {table}') or 0
+            next_id = max(last_id, max_id) + 1
+
+        query = '''
+        INSERT INTO id_counters(table_name, last_id) VALUES(?, ?)
+        ON CONFLICT(table_name) DO UPDATE SET last_id = excluded.last_id
+        '''
+        self.execute(query, [table, next_id + count - 1])
+        self._next_ids[table] = next_id + count
+        return list(range(next_id, next_id + count))
+
+    def insert_many(self, table, pairss) -> None:
+        '''
+        Like insert, but for a list of pairs dicts which all have the same keys,
+        inserted with a single executemany.
+        '''
+        if not pairss:
+            return
+
+        if isinstance(table, type) and issubclass(table, worms.Object):
+            table = table.table
+        self.assert_table_exists(table)
+        self.assert_transaction_active()
+
+        (qmarks, _) = sqlhelpers.insert_filler(pairss[0])
+        query = f'INSERT INTO {table} {qmarks}'
+        columns = list(pairss[0].keys())
+        bindingss = [[pairs[column] for column in columns] for pairs in pairss]
+        log.loud('%s x %d', query, len(bindingss))
+        self.sql_write.cursor().executemany(query, bindingss)
+
+    def rollback(self, savepoint=None) -> None:
+        try:
+            super().rollback(savepoint=savepoint)
+        finally:
+            self._next_ids.clear()
+            # The rollback may have undone changes that our feed tree already
+            # knows about. After rolling back to a savepoint, the next call to
+            # get_feed_tree rebuilds it with the changes that survived. The
+            # shared tree never saw any of them.
+            with self._feed_tree_lock:
+                self._pending_feed_tree = None
@@ -1,12 +1,15 @@
 import requests
+import requests.adapters
 
 from voussoirkit import sqlhelpers
 
-DATABASE_VERSION = 1
+from . import hostlimiter
+
+DATABASE_VERSION = 13
 
 DB_INIT = f'''
 CREATE TABLE IF NOT EXISTS feeds(
-    id INT PRIMARY KEY NOT NULL,
+    id INTEGER PRIMARY KEY NOT NULL,
     parent_id INT,
     rss_url TEXT,
     web_url TEXT,
@@ -21,12 +24,38 @@ CREATE TABLE IF NOT EXISTS feeds(
     http_headers TEXT,
     isolate_guids BOOLEAN NOT NULL,
     icon BLOB,
-    ui_order_rank INT
+    ui_order_rank INT,
+    -- The validators from the last 200 response, so we can make conditional
+    -- requests with If-None-Match and If-Modified-Since.
+    http_etag TEXT,
+    http_last_modified TEXT,
+    -- Hash of the last response body that was ingested. If the next body is
+    -- identical we can skip parsing it.
+    last_content_hash TEXT,
+    -- The origin told us not to come back before this timestamp, through
+    -- Cache-Control / Expires on a good response or Retry-After on a 429 / 503.
+    refresh_not_before INT,
+    -- The number of refresh attempts in a row that have failed.
+    refresh_failures INT NOT NULL,
+    -- If adaptive_refresh is enabled, the feed is refreshed every
+    -- adaptive_interval instead of autorefresh_interval. The interval is
+    -- predicted from the feed's publish history, bounded by the min and max.
+    adaptive_refresh BOOLEAN NOT NULL,
+    adaptive_interval_min INT,
+    adaptive_interval_max INT,
+    adaptive_interval INT,
+    -- JSON list of the guids of the newest news seen in the feed's document,
+    -- newest first. While refreshing, we stop parsing the document after a
+    -- run of these. NULL if the document is not ordered newest first, in
+    -- which case the whole document is always parsed.
+    high_water_guids TEXT,
+    -- When the whole document was last parsed. Every so often we do a full
+    -- pass regardless of the high water mark.
+    last_full_ingest INT
 );
-CREATE INDEX IF NOT EXISTS index_feeds_id on feeds(id);
 ----------------------------------------------------------------------------------------------------
 CREATE TABLE IF NOT EXISTS filters(
-    id INT PRIMARY KEY NOT NULL,
+    id INTEGER PRIMARY KEY NOT NULL,
     name TEXT,
     created INT,
     conditions TEXT NOT NULL,
@@ -34,7 +63,7 @@ CREATE TABLE IF NOT EXISTS filters(
 );
 ----------------------------------------------------------------------------------------------------
 CREATE TABLE IF NOT EXISTS news(
-    id INT PRIMARY KEY NOT NULL,
+    id INTEGER PRIMARY KEY NOT NULL,
     feed_id INT NOT NULL,
     original_feed_id INT NOT NULL,
     rss_guid TEXT NOT NULL,
@@ -55,27 +84,44 @@ CREATE TABLE IF NOT EXISTS news(
     -- against the enclosure fields to justify a perf difference.
     authors TEXT,
     enclosures TEXT,
+    -- helpers.hash_guid of the rss_guid, including the isolation prefix. Used
+    -- to look for duplicates with a much smaller index than one on rss_guid.
+    guid_hash INT NOT NULL,
     FOREIGN KEY(feed_id) REFERENCES feeds(id)
 );
-CREATE INDEX IF NOT EXISTS index_news_id on news(id);
-CREATE INDEX IF NOT EXISTS index_news_feed_id on news(feed_id);
+-- The order of these indices matters. Until the database has been analyzed,
+-- SQLite thinks a partial index is as big as a full one, and when two indices
+-- look equally good it picks the one that was created last. So the narrower
+-- partial indices come after the broader ones. BringDB.check_query_plans
+-- makes sure the listings get the index that was meant for them.
+
+-- Any news of a feed or folder, published desc.
+CREATE INDEX IF NOT EXISTS index_news_feed_id_published on news(feed_id, published);
 
 -- Not used very often, but when you switch a feed's isolate_guids setting on
 -- and off, we need to rewrite the rss_guid for all news items from that feed,
--- so having an index there really helps.
-CREATE INDEX IF NOT EXISTS index_news_original_feed_id on news(original_feed_id);
+-- so having an index there really helps. The published column lets the
+-- adaptive intervals count each feed's recent news without a table scan.
+CREATE INDEX IF NOT EXISTS index_news_original_feed_id_published on news(original_feed_id, published);
+
+-- Less common. Read + unread news that's not recycled, and the recycle bin,
+-- published desc, from all feeds. From one feed or folder, the
+-- feed_id_published index is good enough.
+CREATE INDEX IF NOT EXISTS index_news_unrecycled_published on news(published) WHERE recycled == 0;
+CREATE INDEX IF NOT EXISTS index_news_recycled_published on news(published) WHERE recycled == 1;
 
 -- This will be the most commonly used search index. We search for news that is
 -- not read or recycled, ordered by published desc, and belongs to one of
--- several feeds (feed or folder of feeds).
-CREATE INDEX IF NOT EXISTS index_news_recycled_read_published_feed_id on news(recycled, read, published, feed_id);
+-- several feeds (feed or folder of feeds). It also serves the recount of the
+-- unread counters.
+-- Being partial, it only holds the unread news, which are usually few.
+CREATE INDEX IF NOT EXISTS index_news_unread_feed_id_published on news(feed_id, published) WHERE recycled == 0 AND read == 0;
 
--- Less common but same idea. Finding read + unread news that's not recycled,
--- published desc, from your feed or folder.
-CREATE INDEX IF NOT EXISTS index_news_recycled_published_feed_id on news(recycled, published, feed_id);
+-- The same, when looking at all feeds at once.
+CREATE INDEX IF NOT EXISTS index_news_unread_published on news(published) WHERE recycled == 0 AND read == 0;
 
 -- Used to figure out which incoming news is new and which already exist.
-CREATE INDEX IF NOT EXISTS index_news_guid on news(rss_guid);
+CREATE INDEX IF NOT EXISTS index_news_guid_hash on news(guid_hash);
 ----------------------------------------------------------------------------------------------------
 
 ----------------------------------------------------------------------------------------------------
@@ -87,9 +133,27 @@ CREATE TABLE IF NOT EXISTS feed_filter_rel(
     FOREIGN KEY(filter_id) REFERENCES filters(id),
     PRIMARY KEY(feed_id, filter_id)
 );
+----------------------------------------------------------------------------------------------------
+-- The number of news in each feed that are neither read nor recycled, kept up
+-- to date by the methods that change those, so that the unread counts don't
+-- need to count the news table. A missing row means 0.
+CREATE TABLE IF NOT EXISTS feed_unread_counts(
+    feed_id INTEGER PRIMARY KEY NOT NULL,
+    unread INT NOT NULL,
+    FOREIGN KEY(feed_id) REFERENCES feeds(id)
+);
+----------------------------------------------------------------------------------------------------
+-- The largest id ever given out in each table, so that the id of a deleted
+-- row is not given to a new one. See BringDB.generate_ids.
+CREATE TABLE IF NOT EXISTS id_counters(
+    table_name TEXT PRIMARY KEY NOT NULL,
+    last_id INT NOT NULL
+);
 '''
 SQL_COLUMNS = sqlhelpers.extract_table_column_map(DB_INIT)
 SQL_INDEX = sqlhelpers.reverse_table_column_map(SQL_COLUMNS)
+# Older builds of sqlite allow at most this many ? bindings in one statement.
+SQL_MAX_VARIABLES = 999
 
 DEFAULT_DATADIR = '_bringrss'
 DEFAULT_DBNAME = 'bringrss.db'
@@ -98,8 +162,59 @@ DEFAULT_DBNAME = 'bringrss.db'
 # making requests to third parties its fair for them to know in case our HTTP
 # behavior changes.
 VERSION = '0.0.1'
+
+# Subscriptions tend to be concentrated on a handful of big hosts, so these
+# limits are per host. They apply to every request that goes through
+# http_session via helpers / objects.
+HTTP_MAX_REQUESTS_PER_HOST = 2
+HTTP_MIN_INTERVAL_PER_HOST = 1
+http_host_limiter = hostlimiter.HostLimiter(
+    concurrency=HTTP_MAX_REQUESTS_PER_HOST,
+    interval=HTTP_MIN_INTERVAL_PER_HOST,
+)
+
 http_session = requests.Session()
 http_session.headers['User-Agent'] = f'voussoir/BringRSS v{VERSION}'
+# By default requests keeps connection pools for only 10 hosts, which means
+# closing and reopening connections when refreshing feeds from many hosts.
+# Each host's pool only needs to be as big as the number of requests we allow
+# to that host at once.
+_http_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=100,
+    pool_maxsize=HTTP_MAX_REQUESTS_PER_HOST,
+)
+http_session.mount('http://', _http_adapter)
+http_session.mount('https://', _http_adapter)
+
+# The longest that a Cache-Control, Expires, or Retry-After header is allowed to
+# postpone a feed's autorefresh, in case a server sends something absurd.
+MAX_REFRESH_DEFERRAL = 7 * 24 * 3600
+
+# After a failed refresh, the feed is retried after REFRESH_FIRST_RETRY seconds,
+# then twice that, and so on, until reaching its regular autorefresh_interval.
+REFRESH_FIRST_RETRY = 15 * 60
+# After this many failures in a row, the feed stops autorefreshing until it is
+# refreshed successfully by hand. Set to None to keep retrying forever.
+REFRESH_CIRCUIT_BREAKER = 20
+
+# Feeds with adaptive_refresh look at how many news they published within the
+# lookback period to predict how often they publish. These are the default
+# bounds for feeds that don't set their own.
+ADAPTIVE_LOOKBACK = 90 * 24 * 3600
+ADAPTIVE_INTERVAL_MIN = 15 * 60
+ADAPTIVE_INTERVAL_MAX = 7 * 24 * 3600
+
+# Most feeds list their news newest first, so the news we've seen before are at
+# the end of the document. After this many consecutive entries that are in the
+# feed's high water mark, the rest of the document is not parsed. Set to None
+# to always parse the whole document.
+HIGH_WATER_KNOWN_RUN = 10
+# The number of guids kept in each feed's high water mark. This should be
+# comfortably larger than HIGH_WATER_KNOWN_RUN.
+HIGH_WATER_SIZE = 100
+# The whole document is parsed at least this often anyway, in case the feed
+# inserted news further down.
+HIGH_WATER_VERIFY_INTERVAL = 24 * 3600
 
 # Thank you h-j-13
 # https://stackoverflow.com/a/54629675/5430534
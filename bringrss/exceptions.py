@@ -111,6 +111,12 @@ class DatabaseOutOfDate(BringException):
     '''
     error_message = OUTOFDATE
 
+class InvalidCursor(BringException):
+    '''
+    For when a listing cursor can't be parsed.
+    '''
+    error_message = 'Invalid cursor "{}".'
+
 class NoClosestBringDB(BringException):
     '''
     For calls to BringDB.closest_photodb where none exists between cwd and
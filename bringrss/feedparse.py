@@ -0,0 +1,307 @@
+'''
+This module parses RSS and Atom documents into plain records, streaming the
+entries off the parser with lxml instead of building a BeautifulSoup tree of
+the whole document. Each entry's element is released as soon as its record
+has been extracted, so memory stays proportional to one entry instead of the
+whole feed.
+
+The records hold the raw text and attributes of the elements that the ingest
+functions care about. None means the element was not present, which is
+different from an element with empty text. The ingest functions in bringdb
+apply the same interpretation to these records that they used to apply to
+the BeautifulSoup tags, so the resulting news are identical.
+
+Elements are matched by their local name regardless of namespace, which is how
+BeautifulSoup's find behaves. So an rss item's <itunes:author> counts as an
+author, for example.
+'''
+from lxml import etree
+
+from voussoirkit import vlogging
+
+log = vlogging.get_logger(__name__)
+
+# The document is fed to the parser in pieces of this many bytes or characters,
+# and the finished entries are extracted between pieces.
+CHUNK_SIZE = 2 ** 16
+
+class ParsedFeed:
+    '''
+    The result of parse_feed.
+
+    kind:
+        'rss' or 'atom', or None if the document is neither.
+
+    title, description:
+        The text of the first <title> and <description> / <subtitle> in the
+        channel or feed element, or None.
+
+    rss_link:
+        The text of the first <link> in the rss channel, or None.
+
+    atom_links:
+        The attributes of the <link> elements that are direct children of the
+        atom feed element.
+
+    entries:
+        One record dict per rss <item> or atom <entry>, in document order.
+
+    complete:
+        False if parsing stopped early after a run of known entries, in which
+        case the entries, and any properties that come after them in the
+        document, are missing.
+    '''
+    def __init__(self):
+        self.kind = None
+        self.title = None
+        self.description = None
+        self.rss_link = None
+        self.atom_links = []
+        self.entries = []
+        self.complete = True
+
+    def __repr__(self):
+        return f'ParsedFeed(kind={self.kind}, entries={len(self.entries)}, complete={self.complete})'
+
+def _first(element, name):
+    for descendant in element.iterdescendants('{*}' + name):
+        return descendant
+    return None
+
+def _localname(element) -> str:
+    return element.tag.rpartition('}')[2]
+
+def _text(element):
+    return ''.join(element.itertext())
+
+def _text_or_none(element):
+    if element is None:
+        return None
+    return _text(element)
+
+def _first_text(element, name):
+    return _text_or_none(_first(element, name))
+
+def atom_entry_record(entry) -> dict:
+    '''
+    Extract the fields needed by BringDB._prepare_news_atom and
+    _finish_news_atom from a complete <entry> element.
+    '''
+    authors = []
+    for author in entry.iterdescendants('{*}author'):
+        authors.append({
+            'name': _first_text(author, 'name'),
+            'email': _first_text(author, 'email'),
+            'uri': _first_text(author, 'uri'),
+        })
+
+    record = {
+        'id': _first_text(entry, 'id'),
+        'updated': _first_text(entry, 'updated'),
+        'published': _first_text(entry, 'published'),
+        'title': _first_text(entry, 'title'),
+        'content': _first_text(entry, 'content'),
+        'links': [dict(link.attrib) for link in entry.iterchildren('{*}link')],
+        'enclosures': [
+            dict(link.attrib) for link in entry.iterdescendants('{*}link')
+            if link.get('rel') == 'enclosure'
+        ],
+        'authors': authors,
+    }
+    return record
+
+def rss_item_record(item) -> dict:
+    '''
+    Extract the fields needed by BringDB._prepare_news_rss and
+    _finish_news_rss from a complete <item> element.
+    '''
+    guid = _first(item, 'guid')
+    record = {
+        'guid': _text_or_none(guid),
+        'guid_is_permalink': None if guid is None else guid.get('isPermalink'),
+        'title': _first_text(item, 'title'),
+        'description': _first_text(item, 'description'),
+        'link': _first_text(item, 'link'),
+        'pubDate': _first_text(item, 'pubDate'),
+        'comments': _first_text(item, 'comments'),
+        'authors': [_text(author) for author in item.iterdescendants('{*}author')],
+        'enclosures': [dict(enclosure.attrib) for enclosure in item.iterdescendants('{*}enclosure')],
+    }
+    return record
+
+class _FeedStreamer:
+    def __init__(self, *, is_known=None, known_run=None):
+        self.parsed = ParsedFeed()
+        self.is_known = is_known
+        self.known_run = known_run
+        self.current_known_run = 0
+        # The first <rss> and its first <channel>, or the first <feed>.
+        self.root = None
+        self.container = None
+        self.container_open = False
+        # Entries can contain other entries, in theory. Only the outermost ones
+        # are released after being parsed, since the inner elements belong to
+        # the outer entry too.
+        self.entry_name = None
+        self.open_entries = 0
+        self.first_title = None
+        self.first_description = None
+        self.first_link = None
+
+    def start(self, element):
+        name = _localname(element)
+
+        if self.root is None:
+            if name == 'rss':
+                self.root = element
+                self.parsed.kind = 'rss'
+                self.entry_name = 'item'
+            elif name == 'feed':
+                self.root = element
+                self.container = element
+                self.container_open = True
+                self.parsed.kind = 'atom'
+                self.entry_name = 'entry'
+            return
+
+        if self.container is None:
+            if name == 'channel' and self.parsed.kind == 'rss':
+                self.container = element
+                self.container_open = True
+            return
+
+        if not self.container_open:
+            return
+
+        # The properties come from the first matching element anywhere in the
+        # container, by order of appearance.
+        if name == 'title' and self.first_title is None:
+            self.first_title = element
+        elif name == 'link' and self.first_link is None:
+            self.first_link = element
+        elif self.first_description is None:
+            if name == 'description' and self.parsed.kind == 'rss':
+                self.first_description = element
+            elif name == 'subtitle' and self.parsed.kind == 'atom':
+                self.first_description = element
+
+        if name == self.entry_name:
+            self.open_entries += 1
+
+    def end(self, element):
+        if not self.container_open:
+            return
+
+        if element is self.container:
+            self.container_open = False
+            return
+
+        if element is self.first_title:
+            self.parsed.title = _text(element)
+        elif element is self.first_description:
+            self.parsed.description = _text(element)
+        elif element is self.first_link and self.parsed.kind == 'rss':
+            self.parsed.rss_link = _text(element)
+
+        name = _localname(element)
+        if name == 'link' and self.parsed.kind == 'atom' and element.getparent() is self.container:
+            self.parsed.atom_links.append(dict(element.attrib))
+
+        if name != self.entry_name:
+            return
+
+        if self.parsed.kind == 'rss':
+            record = rss_item_record(element)
+        else:
+            record = atom_entry_record(element)
+        self.parsed.entries.append(record)
+
+        self.open_entries -= 1
+        if self.open_entries == 0:
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+        if self.is_known is None or self.open_entries > 0:
+            return
+
+        if self.is_known(self.parsed.kind, record):
+            self.current_known_run += 1
+        else:
+            self.current_known_run = 0
+
+        if self.current_known_run >= self.known_run:
+            log.debug('Stopping after %d known entries.', self.current_known_run)
+            self.parsed.complete = False
+
+    def handle_events(self, events):
+        for (event, element) in events:
+            if not self.parsed.complete:
+                return
+            if event == 'start':
+                self.start(element)
+            else:
+                self.end(element)
+
+def parse_feed(data, *, is_known=None, known_run=None) -> ParsedFeed:
+    '''
+    Parse an RSS or Atom document. If the document is neither, the returned
+    ParsedFeed has kind None.
+
+    data:
+        If bytes, the parser determines the encoding from the BOM or the XML
+        declaration, and the document must be well-formed or else
+        lxml.etree.XMLSyntaxError is raised.
+
+        If str, the text has already been decoded, so any encoding declaration
+        is ignored. Like BeautifulSoup, this uses lxml's recover mode so that
+        slightly broken documents still parse.
+
+    is_known, known_run:
+        If is_known is given, it is called as is_known(kind, record) with each
+        outermost entry. Once it returns True for known_run entries in a row,
+        the rest of the document is not parsed and the ParsedFeed's complete
+        is False.
+    '''
+    recover = isinstance(data, str)
+    if recover and data.startswith('\N{BYTE ORDER MARK}'):
+        data = data[1:]
+
+    parser = etree.XMLPullParser(events=('start', 'end'), recover=recover)
+    streamer = _FeedStreamer(is_known=is_known, known_run=known_run)
+    for index in range(0, len(data), CHUNK_SIZE):
+        parser.feed(data[index:index + CHUNK_SIZE])
+        streamer.handle_events(parser.read_events())
+        if not streamer.parsed.complete:
+            return streamer.parsed
+
+    try:
+        parser.close()
+    except etree.XMLSyntaxError:
+        if not recover:
+            raise
+        # Nothing at all could be parsed.
+    streamer.handle_events(parser.read_events())
+
+    # An rss document needs a channel.
+    if streamer.container is None:
+        streamer.parsed.kind = None
+
+    return streamer.parsed
+
+def parse_response(response, **kwargs) -> ParsedFeed:
+    '''
+    Parse the body of a requests Response. The kwargs are passed to
+    parse_feed.
+
+    The raw bytes are given to the parser so that it can follow the XML
+    declaration. Accessing response.text instead would make requests guess the
+    charset of the whole body whenever the Content-Type doesn't say, which is
+    very slow for large feeds. Only if the bytes don't parse do we fall back to
+    response.text and recover mode.
+    '''
+    try:
+        return parse_feed(response.content, **kwargs)
+    except etree.XMLSyntaxError as exc:
+        log.debug('Falling back to response.text for %s because %s', response.url, exc)
+        return parse_feed(response.text, **kwargs)
@@ -0,0 +1,158 @@
+import threading
+
+class FeedTree:
+    '''
+    The FeedTree holds the parent / child structure of all the feeds in memory,
+    so that walking up or down the tree doesn't need a query for every node.
+    Feeds are referred to by their IDs, and the root feeds are the children of
+    None.
+
+    Children are ordered by ui_order_rank, like the feeds table's
+    `ORDER BY ui_order_rank ASC`.
+
+    Every modifying method can be called with a change that the tree already
+    reflects, in which case nothing happens. This way, a tree that was built
+    after a change was written to the database can still be told about it.
+
+    The reading methods treat a feed that the tree doesn't know as one without
+    parents or children, because the tree of committed feeds can be a moment
+    behind the database. All methods hold the lock, and the children lists
+    are kept sorted by replacing them whenever they change instead of sorting
+    them in place while someone else may be reading them.
+    '''
+    def __init__(self, rows=()):
+        '''
+        rows:
+            Iterable of (id, parent_id, ui_order_rank).
+        '''
+        self.lock = threading.RLock()
+        # {feed id: parent id or None}
+        self.parents = {}
+        # {feed id: ui_order_rank}
+        self.ranks = {}
+        # {parent id or None: [child ids]}
+        self.children = {None: []}
+
+        for (id, parent_id, ui_order_rank) in rows:
+            self.parents[id] = parent_id
+            self.ranks[id] = ui_order_rank
+            self.children.setdefault(id, [])
+            self.children.setdefault(parent_id, []).append(id)
+
+        for children in self.children.values():
+            children.sort(key=self._sort_key)
+
+    def __contains__(self, id):
+        with self.lock:
+            return id in self.parents
+
+    def __len__(self):
+        with self.lock:
+            return len(self.parents)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(feeds={len(self)})'
+
+    def _sort_key(self, id):
+        return (self.ranks[id], id)
+
+    def _set_children(self, parent_id, children):
+        self.children[parent_id] = sorted(children, key=self._sort_key)
+
+    def add(self, id, parent_id, ui_order_rank):
+        with self.lock:
+            if id in self.parents:
+                self.set_parent(id, parent_id)
+                self.set_ui_order_rank(id, ui_order_rank)
+                return
+
+            self.parents[id] = parent_id
+            self.ranks[id] = ui_order_rank
+            self.children.setdefault(id, [])
+            self._set_children(parent_id, self.children.get(parent_id, []) + [id])
+
+    def get_ancestors(self, id) -> list:
+        '''
+        Return the IDs of the feeds above this one, nearest first.
+        '''
+        with self.lock:
+            ancestors = []
+            parent_id = self.parents.get(id)
+            while parent_id is not None:
+                ancestors.append(parent_id)
+                parent_id = self.parents[parent_id]
+            return ancestors
+
+    def get_children(self, id) -> list:
+        '''
+        Return the IDs of the feeds directly below this one, or the root feeds
+        if id is None.
+        '''
+        with self.lock:
+            return self.children.get(id, []).copy()
+
+    def get_descendants(self, id, *, yield_self=True) -> list:
+        '''
+        Return the IDs of the feeds below this one, in the same depth-first
+        order as Feed.walk_children.
+        '''
+        with self.lock:
+            descendants = []
+            stack = [id] if yield_self else list(reversed(self.children.get(id, [])))
+            while stack:
+                current = stack.pop()
+                descendants.append(current)
+                stack.extend(reversed(self.children.get(current, [])))
+            return descendants
+
+    def get_subtree_ids(self, id) -> set:
+        '''
+        Return the set of this feed's ID and the IDs of all its descendants.
+        '''
+        with self.lock:
+            subtree = {id}
+            stack = [id]
+            while stack:
+                children = self.children.get(stack.pop(), [])
+                subtree.update(children)
+                stack.extend(children)
+            return subtree
+
+    def remove(self, id):
+        '''
+        Remove this feed from the tree. Its children should have been moved
+        elsewhere already.
+        '''
+        with self.lock:
+            if id not in self.parents:
+                return
+
+            if self.children.get(id):
+                raise ValueError(f'Feed {id} still has children {self.children[id]}.')
+
+            parent_id = self.parents.pop(id)
+            self.children.pop(id, None)
+            self.children[parent_id] = [child for child in self.children[parent_id] if child != id]
+            self.ranks.pop(id)
+
+    def set_parent(self, id, parent_id):
+        with self.lock:
+            old_parent_id = self.parents[id]
+            if old_parent_id == parent_id:
+                return
+
+            if parent_id is not None and parent_id in self.get_subtree_ids(id):
+                raise ValueError(f'Feed {parent_id} is a descendant of {id}.')
+
+            self.children[old_parent_id] = [child for child in self.children[old_parent_id] if child != id]
+            self._set_children(parent_id, self.children.get(parent_id, []) + [id])
+            self.parents[id] = parent_id
+
+    def set_ui_order_rank(self, id, ui_order_rank):
+        with self.lock:
+            if self.ranks[id] == ui_order_rank:
+                return
+
+            self.ranks[id] = ui_order_rank
+            parent_id = self.parents[id]
+            self._set_children(parent_id, self.children[parent_id])
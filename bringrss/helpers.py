@@ -1,66 +1,198 @@
-import bs4
 import datetime
 import dateutil.parser
+import email.utils
+import functools
+import hashlib
 import importlib
+import re
+import requests
 import sys
 
 from . import constants
 
-from voussoirkit import cacheclass
 from voussoirkit import httperrors
 from voussoirkit import pathclass
 from voussoirkit import vlogging
 
 log = vlogging.get_logger(__name__)
 
-_xml_etag_cache = cacheclass.Cache(maxlen=100)
-
 def dateutil_parse(string):
     return dateutil.parser.parse(string, tzinfos=constants.DATEUTIL_TZINFOS)
 
-def fetch_xml(url, headers={}) -> bs4.BeautifulSoup:
-    log.debug('Fetching %s.', url)
-    response = constants.http_session.get(url, headers=headers)
-    httperrors.raise_for_status(response)
-    soup = bs4.BeautifulSoup(response.text, 'xml')
-    return soup
+_MONTHS = {
+    month: index + 1 for (index, month) in
+    enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'])
+}
+# RFC 822 as used by RSS pubDate, e.g. "Tue, 10 Jun 2003 04:00:00 GMT".
+# Single letter military zones other than Z are left to dateutil, which does not
+# treat them as zones.
+_RFC822_PATTERN = re.compile(r'''
+    ^\s*
+    (?:[A-Za-z]{3},?\s*)?
+    (?P<day>\d{1,2})\s+(?P<month>[A-Za-z]{3})\s+(?P<year>\d{4})\s+
+    (?P<hour>\d{1,2}):(?P<minute>\d{2})(?::(?P<second>\d{2}))?\s*
+    (?:(?P<offset>[+-]\d{4})|(?P<zone>Z|[A-Z]{2,5}))
+    \s*$
+''', re.VERBOSE)
+
+def _parse_rfc822(string):
+    match = _RFC822_PATTERN.match(string)
+    if not match:
+        return None
+
+    month = _MONTHS.get(match.group('month').lower())
+    if month is None:
+        return None
+
+    if match.group('offset'):
+        offset = match.group('offset')
+        seconds = (int(offset[1:3]) * 3600) + (int(offset[3:5]) * 60)
+        if offset[0] == '-':
+            seconds = -seconds
+    else:
+        seconds = constants.DATEUTIL_TZINFOS.get(match.group('zone'))
+        if seconds is None:
+            return None
+
+    date = datetime.datetime(
+        year=int(match.group('year')),
+        month=month,
+        day=int(match.group('day')),
+        hour=int(match.group('hour')),
+        minute=int(match.group('minute')),
+        second=int(match.group('second') or 0),
+        tzinfo=datetime.timezone(datetime.timedelta(seconds=seconds)),
+    )
+    return date
+
+def _parse_rfc3339(string):
+    # fromisoformat also accepts plain dates and other ISO 8601 forms, but
+    # we only want to handle full timestamps with an explicit offset.
+    if len(string) < 20 or string[10] not in 'Tt ':
+        return None
+
+    try:
+        date = datetime.datetime.fromisoformat(string)
+    except ValueError:
+        return None
+
+    if date.tzinfo is None:
+        return None
 
-def fetch_xml_cached(url, headers={}) -> bs4.BeautifulSoup:
+    return date
+
+@functools.lru_cache(maxsize=10000)
+def parse_timestamp(string) -> float:
+    '''
+    Return the unix timestamp of a date string from a feed.
+
+    Almost all feeds use RFC 822 (RSS) or RFC 3339 (Atom), which are parsed
+    directly because dateutil's generic parser is much slower. Anything else,
+    including timestamps without a timezone, goes to dateutil_parse so the
+    results are the same as they have always been. The results are cached
+    because the same strings come back on every refresh.
+    '''
+    string = string.strip()
+    date = _parse_rfc822(string) or _parse_rfc3339(string)
+    if date is None:
+        date = dateutil_parse(string)
+    return date.timestamp()
+
+def fetch_xml_conditional(url, headers={}, *, etag=None, last_modified=None) -> requests.Response:
     '''
-    Fetch the RSS / Atom feed, using a local cache to take advantage of HTTP304
-    responses.
+    Fetch the RSS / Atom feed as a conditional request, using the ETag and
+    Last-Modified validators that came with the previous response. The caller
+    is responsible for storing those between calls.
+
+    Returns the response without parsing it, so that the caller can decide
+    whether it's worth parsing. If the server responds 304 Not Modified, there
+    is no body.
     '''
-    cached = _xml_etag_cache.get(url)
-    if cached and cached['request_headers'] == headers:
-        headers = headers.copy()
-        headers['if-none-match'] = cached['etag']
+    headers = headers.copy()
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
 
-    # To do: use expires / cache-control to avoid making the request at all.
     log.debug('Fetching %s.', url)
-    response = constants.http_session.get(url, headers=headers)
+    with constants.http_host_limiter.limit(url):
+        response = constants.http_session.get(url, headers=headers)
     httperrors.raise_for_status(response)
 
-    if cached and response.status_code == 304:
-        # Consider: after returning the cached text, it will still go through
-        # the rest of the xml parsing and news ingesting steps even though it
-        # will almost certainly add nothing new. But I say almost certainly
-        # because you could have changed feed settings like isolate_guids.
-        # May be room for optimization but it's not worth creating weird edge
-        # cases over.
-        log.debug('304 Using cached XML for %s.', url)
-        response_text = cached['text']
-    else:
-        response_text = response.text
-        if response.headers.get('etag'):
-            cached = {
-                'request_headers': headers,
-                'etag': response.headers['etag'],
-                'text': response_text,
-            }
-            _xml_etag_cache[url] = cached
-
-    soup = bs4.BeautifulSoup(response_text, 'xml')
-    return soup
+    if response.status_code == 304:
+        log.debug('304 Not modified %s.', url)
+
+    return response
+
+def get_freshness_lifetime(response) -> float:
+    '''
+    Return the number of seconds that the response may be considered fresh
+    according to its Cache-Control or Expires headers, or None if the server
+    did not say.
+    '''
+    cache_control = response.headers.get('Cache-Control', '')
+    directives = {}
+    for directive in cache_control.split(','):
+        (key, _, value) = directive.strip().partition('=')
+        directives[key.lower()] = value.strip().strip('"')
+
+    if 'no-store' in directives or 'no-cache' in directives:
+        return 0
+
+    if 'max-age' in directives:
+        try:
+            lifetime = int(directives['max-age'])
+        except ValueError:
+            return None
+        try:
+            age = int(response.headers.get('Age', 0))
+        except ValueError:
+            age = 0
+        return max(0, lifetime - age)
+
+    expires = response.headers.get('Expires')
+    if expires is None:
+        return None
+
+    # An invalid Expires such as "0" means already expired.
+    expires = parse_http_date(expires)
+    if expires is None:
+        return 0
+
+    date = parse_http_date(response.headers.get('Date', ''))
+    if date is None:
+        date = now()
+    return max(0, expires - date)
+
+def get_retry_after(response) -> float:
+    '''
+    Return the number of seconds that the Retry-After header asks us to wait,
+    or None if there isn't one.
+    '''
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+
+    retry_after = retry_after.strip()
+    if retry_after.isdigit():
+        return int(retry_after)
+
+    retry_after = parse_http_date(retry_after)
+    if retry_after is None:
+        return None
+    return max(0, retry_after - now())
+
+def hash_content(content:bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+def hash_guid(guid:str) -> int:
+    '''
+    Return a signed 64-bit hash of the guid, which fits in an sqlite INT.
+    Different guids can have the same hash, so a match has to be confirmed by
+    comparing the guids themselves.
+    '''
+    digest = hashlib.blake2b(guid.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
 
 def import_module_by_path(path):
     '''
@@ -135,29 +267,33 @@ def now(timestamp=True):
         return n.timestamp()
     return n
 
-def pick_web_url_atom(entry:bs4.BeautifulSoup):
-    best_web_url = entry.find('link', {'rel': 'alternate', 'type': 'text/html'}, recursive=False)
-    if best_web_url:
-        return best_web_url['href']
-
-    alternate_url = entry.find('link', {'rel': 'alternate'}, recursive=False)
-    if alternate_url:
-        return alternate_url['href']
-
-    link = entry.find('link', recursive=False)
-    if link:
-        return link['href']
-
-    return None
+def parse_http_date(string) -> float:
+    '''
+    Return the timestamp of an HTTP-date like "Sun, 06 Nov 1994 08:49:37 GMT",
+    or None if it can't be parsed.
+    '''
+    try:
+        date = email.utils.parsedate_to_datetime(string)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
 
-def xml_is_atom(soup:bs4.BeautifulSoup):
-    if soup.find('feed'):
-        return True
+def pick_web_url_atom(links:list):
+    '''
+    Given the attribute dicts of an atom feed or entry's <link> elements, return
+    the href of the one that is most likely to be the html page.
+    '''
+    for link in links:
+        if link.get('rel') == 'alternate' and link.get('type') == 'text/html':
+            return link['href']
 
-    return False
+    for link in links:
+        if link.get('rel') == 'alternate':
+            return link['href']
 
-def xml_is_rss(soup:bs4.BeautifulSoup):
-    if soup.find('rss') and soup.find('rss').find('channel'):
-        return True
+    if links:
+        return links[0]['href']
 
-    return False
+    return None
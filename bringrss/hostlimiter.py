@@ -0,0 +1,180 @@
+import contextlib
+import threading
+import time
+import urllib.parse
+
+class HostLimiter:
+    '''
+    The HostLimiter keeps us polite towards each web host. No more than
+    `concurrency` requests to the same host may be in progress at once, and the
+    start of each request must be at least `interval` seconds after the start
+    of the previous request to that host. Different hosts do not affect each
+    other.
+
+    Usage:
+
+        with limiter.limit(url):
+            response = session.get(url)
+
+    A thread that is already inside a request to a host can enter limit for
+    the same host again without claiming a second request, though it still
+    waits for the interval. This lets a caller claim the request with
+    try_acquire before handing the url to code that uses limit itself, and
+    the first limit after try_acquire doesn't wait since it is the request
+    that was claimed.
+    '''
+    def __init__(self, *, concurrency=2, interval=1):
+        if concurrency < 1:
+            raise ValueError(f'concurrency should be at least 1, not {concurrency}.')
+
+        if interval < 0:
+            raise ValueError(f'interval should be at least 0, not {interval}.')
+
+        self.concurrency = concurrency
+        self.interval = interval
+        self.condition = threading.Condition()
+        # {host: number of requests in progress}
+        self.active = {}
+        # {host: time.monotonic of the last request start}
+        self.last_start = {}
+        # {(thread ident, host): depth} of the threads that are inside a request.
+        self.holders = {}
+        # Holders who claimed with try_acquire and haven't entered limit yet.
+        self.reserved = set()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(concurrency={self.concurrency}, interval={self.interval})'
+
+    def _ready_in(self, host, now):
+        if self.active.get(host, 0) >= self.concurrency:
+            return None
+
+        last_start = self.last_start.get(host)
+        if last_start is None:
+            return 0
+
+        return max(0, last_start + self.interval - now)
+
+    def acquire(self, url):
+        '''
+        Block until the url's host has room for another request, then claim it.
+        You must call release afterwards, or use `limit` instead.
+        '''
+        host = self.host_of(url)
+        holder = (threading.get_ident(), host)
+        with self.condition:
+            if holder in self.reserved:
+                self.reserved.discard(holder)
+                self.holders[holder] += 1
+                return
+
+            if holder in self.holders:
+                while True:
+                    now = time.monotonic()
+                    ready_in = self._interval_ready_in(host, now)
+                    if ready_in == 0:
+                        break
+                    self.condition.wait(timeout=ready_in)
+                self.holders[holder] += 1
+                self.last_start[host] = now
+                return
+
+            while True:
+                now = time.monotonic()
+                ready_in = self._ready_in(host, now)
+                if ready_in == 0:
+                    break
+                # When the host is full, we'll be notified by release.
+                self.condition.wait(timeout=ready_in)
+
+            self._claim(holder, now)
+
+    def _claim(self, holder, now):
+        host = holder[1]
+        self.active[host] = self.active.get(host, 0) + 1
+        self.last_start[host] = now
+        self.holders[holder] = 1
+
+    @staticmethod
+    def host_of(url) -> str:
+        return urllib.parse.urlsplit(url).netloc.lower()
+
+    def _interval_ready_in(self, host, now):
+        return max(0, self.last_start[host] + self.interval - now)
+
+    @contextlib.contextmanager
+    def limit(self, url):
+        self.acquire(url)
+        try:
+            yield
+        finally:
+            self.release(url)
+
+    def ready_in(self, url):
+        '''
+        Return the number of seconds until the url's host will allow another
+        request, 0 if it's ready now, or None if the host has reached its
+        concurrency and we must wait for one of those requests to finish.
+        '''
+        host = self.host_of(url)
+        with self.condition:
+            return self._ready_in(host, time.monotonic())
+
+    def release(self, url):
+        host = self.host_of(url)
+        holder = (threading.get_ident(), host)
+        with self.condition:
+            depth = self.holders.pop(holder) - 1
+            if depth > 0:
+                self.holders[holder] = depth
+                return
+
+            self.reserved.discard(holder)
+            active = self.active[host] - 1
+            if active == 0:
+                del self.active[host]
+            else:
+                self.active[host] = active
+            self.condition.notify_all()
+
+    def try_acquire(self, url):
+        '''
+        Like acquire, but instead of blocking, return the same thing as ready_in
+        would. The request has been claimed only if the return value is 0, in
+        which case you must call release afterwards.
+        '''
+        host = self.host_of(url)
+        holder = (threading.get_ident(), host)
+        with self.condition:
+            now = time.monotonic()
+            if holder in self.holders:
+                ready_in = self._interval_ready_in(host, now)
+                if ready_in == 0:
+                    self.holders[holder] += 1
+                    self.last_start[host] = now
+                return ready_in
+
+            ready_in = self._ready_in(host, now)
+            if ready_in == 0:
+                self._claim(holder, now)
+                self.reserved.add(holder)
+            return ready_in
+
+def round_robin_by_host(feeds) -> list:
+    '''
+    Reorder the feeds so that consecutive feeds are on different hosts as much
+    as possible, preserving the original order within each host. This way a
+    pool of workers spreads itself across hosts instead of queueing up behind
+    one host's limit.
+    '''
+    by_host = {}
+    for feed in feeds:
+        host = HostLimiter.host_of(feed.rss_url or '')
+        by_host.setdefault(host, []).append(feed)
+
+    results = []
+    groups = list(by_host.values())
+    for index in range(max((len(group) for group in groups), default=0)):
+        results.extend(group[index] for group in groups if index < len(group))
+
+    return results
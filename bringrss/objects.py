@@ -5,6 +5,7 @@ import io
 import json
 import PIL.Image
 import re
+import time
 import traceback
 import types
 import typing
@@ -12,9 +13,11 @@ import urllib.parse
 
 from . import constants
 from . import exceptions
+from . import feedparse
 from . import helpers
 
 from voussoirkit import expressionmatch
+from voussoirkit import httperrors
 from voussoirkit import imagetools
 from voussoirkit import pathclass
 from voussoirkit import sentinel
@@ -26,6 +29,11 @@ from voussoirkit import worms
 log = vlogging.get_logger(__name__)
 
 class ObjectBase(worms.Object):
+    # worms.Object doesn't declare __slots__, so every instance still has a
+    # __dict__ for the attributes that worms sets. These slots keep ours out
+    # of it, for the subclasses like News that have slots of their own.
+    __slots__ = ('bringdb', '_author')
+
     def __init__(self, bringdb):
         super().__init__(bringdb)
         self.bringdb = bringdb
@@ -58,6 +66,20 @@ class Feed(ObjectBase):
         self.isolate_guids = db_row['isolate_guids']
         self.icon = db_row['icon']
         self.ui_order_rank = db_row['ui_order_rank']
+        self.http_etag = db_row['http_etag']
+        self.http_last_modified = db_row['http_last_modified']
+        self.last_content_hash = db_row['last_content_hash']
+        self.refresh_not_before = db_row['refresh_not_before']
+        self.refresh_failures = db_row['refresh_failures']
+        self.adaptive_refresh = db_row['adaptive_refresh']
+        self.adaptive_interval_min = db_row['adaptive_interval_min']
+        self.adaptive_interval_max = db_row['adaptive_interval_max']
+        self.adaptive_interval = db_row['adaptive_interval']
+        if db_row['high_water_guids'] is not None:
+            self.high_water_guids = json.loads(db_row['high_water_guids'])
+        else:
+            self.high_water_guids = None
+        self.last_full_ingest = db_row['last_full_ingest']
 
         self._parent = None
 
@@ -67,6 +89,29 @@ class Feed(ObjectBase):
         else:
             return f'Feed:{self.id}'
 
+    @staticmethod
+    def normalize_adaptive_interval_bound(bound):
+        if bound is None:
+            return None
+
+        if isinstance(bound, float):
+            bound = int(bound)
+
+        if not isinstance(bound, int):
+            raise TypeError(bound)
+
+        if bound < 1:
+            raise ValueError(bound)
+
+        return bound
+
+    @staticmethod
+    def normalize_adaptive_refresh(adaptive_refresh):
+        if not isinstance(adaptive_refresh, bool):
+            raise TypeError(adaptive_refresh)
+
+        return adaptive_refresh
+
     @staticmethod
     def normalize_autorefresh_interval(autorefresh_interval):
         if isinstance(autorefresh_interval, float):
@@ -171,6 +216,99 @@ class Feed(ObjectBase):
 
     normalize_web_url = helpers.normalize_string_blank_to_none
 
+    @worms.atomic
+    def _apply_fetch(self, fetch):
+        if fetch.icon is not None and not self.icon:
+            self.set_icon(fetch.icon)
+
+        # If the server said 304, or sent the same document as last time, then
+        # there is nothing new to ingest.
+        if not fetch.unchanged:
+            parsed = fetch.parsed
+            if parsed.kind == 'atom':
+                self._refresh_feed_properties_atom(parsed)
+            elif parsed.kind == 'rss':
+                self._refresh_feed_properties_rss(parsed)
+            else:
+                raise exceptions.NeitherAtomNorRSS(self.rss_url)
+
+            fetch.newss = self.bringdb.ingest_parsed_feed(parsed, feed=self)
+            # The hash is saved only after a successful ingest, so that a
+            # failure doesn't cause us to skip the content next time.
+            self.last_content_hash = fetch.content_hash
+
+        # A 304 response keeps the validators we already have.
+        if fetch.status_code != 304:
+            self.http_etag = fetch.etag
+            self.http_last_modified = fetch.last_modified
+
+        self.last_refresh = int(helpers.now())
+        pairs = {
+            'id': self.id,
+            'last_refresh': self.last_refresh,
+            'http_etag': self.http_etag,
+            'http_last_modified': self.http_last_modified,
+            'last_content_hash': self.last_content_hash,
+        }
+        self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
+
+    @worms.atomic
+    def apply_fetch(self, fetch):
+        '''
+        This is the write phase of a refresh. Given the FeedFetch that came out
+        of self.fetch, update the feed's properties and ingest the news. The
+        attempt is recorded whether it succeeded or not.
+
+        If the fetch or the ingest failed, the exception is stored on the
+        FeedFetch instead of being raised, so that the caller's transaction can
+        commit the last_refresh_error. Check fetch.exception afterwards.
+        '''
+        self.assert_not_deleted()
+
+        if fetch.feed != self:
+            raise ValueError(f'{fetch} does not belong to {self}.')
+
+        if not self.rss_url:
+            self.clear_last_refresh_error()
+            return
+
+        self.last_refresh_attempt = fetch.attempted
+
+        if fetch.exception is None:
+            try:
+                self._apply_fetch(fetch)
+            except Exception as exc:
+                fetch.exception = exc
+                fetch.error = traceback.format_exc()
+
+        self.last_refresh_error = fetch.error
+        self.refresh_not_before = fetch.not_before
+        if fetch.exception is None:
+            self.refresh_failures = 0
+        else:
+            self.refresh_failures += 1
+
+        pairs = {
+            'id': self.id,
+            'last_refresh_attempt': self.last_refresh_attempt,
+            'last_refresh_error': self.last_refresh_error,
+            'refresh_not_before': self.refresh_not_before,
+            'refresh_failures': self.refresh_failures,
+        }
+        self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
+
+    @property
+    def circuit_breaker_tripped(self) -> bool:
+        '''
+        Return True if this feed has failed so many times in a row that it
+        should not be autorefreshed anymore. A successful manual refresh
+        resets it.
+        '''
+        if constants.REFRESH_CIRCUIT_BREAKER is None:
+            return False
+
+        return self.refresh_failures >= constants.REFRESH_CIRCUIT_BREAKER
+
     @worms.atomic
     def clear_last_refresh_error(self):
         if self.last_refresh_error is None:
@@ -183,6 +321,32 @@ class Feed(ObjectBase):
         self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
         self.last_refresh_error = None
 
+    @worms.atomic
+    def clear_refresh_cache(self):
+        '''
+        Forget the HTTP validators, content hash, freshness deferral, and high
+        water mark, so that the next refresh downloads and ingests the whole
+        document even if it hasn't changed.
+        '''
+        self.assert_not_deleted()
+
+        pairs = {
+            'id': self.id,
+            'http_etag': None,
+            'http_last_modified': None,
+            'last_content_hash': None,
+            'refresh_not_before': None,
+            'high_water_guids': None,
+            'last_full_ingest': None,
+        }
+        self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
+        self.http_etag = None
+        self.http_last_modified = None
+        self.last_content_hash = None
+        self.refresh_not_before = None
+        self.high_water_guids = None
+        self.last_full_ingest = None
+
     @worms.atomic
     def delete(self):
         self.assert_not_deleted()
@@ -201,9 +365,16 @@ class Feed(ObjectBase):
         for child in list(self.get_children()):
             child.set_parent(self.parent)
         self.set_filters([])
+        self.bringdb.delete(table='feed_unread_counts', pairs={'feed_id': self.id})
         self.bringdb.delete(table=News, pairs={'feed_id': self.id})
         self.bringdb.delete(table=Feed, pairs={'id': self.id})
+        self.bringdb.get_feed_tree().remove(self.id)
         self.deleted = True
+        # Other feeds may have had news that were skipped as duplicates of the
+        # news we just deleted. That can only happen between feeds that share
+        # guids.
+        if not self.isolate_guids:
+            self.bringdb.clear_ingest_caches(self.bringdb.get_feeds_sharing_guids())
 
     @property
     def display_name(self):
@@ -214,10 +385,102 @@ class Feed(ObjectBase):
         else:
             return str(self.id)
 
+    def fetch(self):
+        '''
+        This is the network phase of a refresh. Download and parse the XML, and
+        the domain's favicon if this feed does not have an icon yet.
+
+        This method does not touch the database, so it should be called while
+        no transaction is open. That way a slow server does not keep the
+        database locked for the duration of its timeout. Pass the returned
+        FeedFetch to apply_fetch inside a transaction afterwards.
+
+        Exceptions are not raised, they are stored on the FeedFetch.
+        '''
+        self.assert_not_deleted()
+
+        fetch = FeedFetch(self)
+        if not self.rss_url:
+            return fetch
+
+        log.info('Fetching %s', self)
+        start = time.monotonic()
+        # Without a content hash, the ingest cache has been cleared and we must
+        # ingest whatever the server has. A conditional request could be
+        # answered with 304, which would skip the ingest, so we don't send
+        # the validators this time.
+        if self.last_content_hash is None:
+            (etag, last_modified) = (None, None)
+        else:
+            (etag, last_modified) = (self.http_etag, self.http_last_modified)
+        try:
+            response = helpers.fetch_xml_conditional(
+                self.rss_url,
+                headers=self.http_headers,
+                etag=etag,
+                last_modified=last_modified,
+            )
+            fetch.status_code = response.status_code
+            fetch.bytes = len(response.content)
+            fetch.etag = response.headers.get('ETag')
+            fetch.last_modified = response.headers.get('Last-Modified')
+            fetch.defer(helpers.get_freshness_lifetime(response))
+
+            if response.status_code == 304:
+                fetch.unchanged = True
+            else:
+                fetch.content_hash = helpers.hash_content(response.content)
+                fetch.unchanged = (fetch.content_hash == self.last_content_hash)
+
+            if fetch.unchanged:
+                log.debug('%s is unchanged since the last refresh.', self)
+            else:
+                fetch.parsed = feedparse.parse_response(
+                    response,
+                    is_known=self._high_water_checker(),
+                    known_run=constants.HIGH_WATER_KNOWN_RUN,
+                )
+                if fetch.parsed.kind is None:
+                    raise exceptions.NeitherAtomNorRSS(self.rss_url)
+
+            if not self.icon:
+                fetch.icon = self._fetch_domain_favicon()
+        except (httperrors.HTTP429, httperrors.HTTP503) as exc:
+            fetch.exception = exc
+            fetch.error = traceback.format_exc()
+            if exc.response is not None:
+                fetch.status_code = exc.response.status_code
+                fetch.defer(helpers.get_retry_after(exc.response))
+        except Exception as exc:
+            fetch.exception = exc
+            fetch.error = traceback.format_exc()
+
+        fetch.duration = time.monotonic() - start
+        return fetch
+
+    def _fetch_domain_favicon(self):
+        '''
+        Return the normalized icon bytes from the rss_url domain's favicon, or
+        None if there isn't a usable one.
+        '''
+        parts = urllib.parse.urlsplit(self.rss_url)
+
+        for path in ['/favicon.ico', '/favicon.png']:
+            url = urllib.parse.urlunsplit(parts._replace(path=path, query='', fragment=''))
+            log.debug('Trying favicon %s', url)
+            with constants.http_host_limiter.limit(url):
+                response = constants.http_session.get(url)
+            if response.ok:
+                try:
+                    return self.normalize_icon(response.content)
+                except Exception:
+                    log.warning(traceback.format_exc())
+
+        return None
+
     def get_children(self):
-        query = 'SELECT * FROM feeds WHERE parent_id == ? ORDER BY ui_order_rank ASC'
-        bindings = [self.id]
-        return self.bringdb.get_feeds_by_sql(query, bindings)
+        child_ids = self.bringdb.get_feed_tree().get_children(self.id)
+        return self.bringdb.get_feeds_by_id_ordered(child_ids)
 
     def get_filters(self):
         query = 'SELECT filter_id FROM feed_filter_rel WHERE feed_id == ? ORDER BY order_rank ASC'
@@ -225,10 +488,46 @@ class Feed(ObjectBase):
         filter_ids = self.bringdb.select_column(query, bindings)
         return [self.bringdb.get_filter(id) for id in filter_ids]
 
+    def get_subtree_ids(self) -> set:
+        '''
+        Return the set of IDs of this feed and all of its descendants.
+        '''
+        return self.bringdb.get_feed_tree().get_subtree_ids(self.id)
+
     def get_unread_count(self):
-        feed_ids = sqlhelpers.listify(descendant.id for descendant in self.walk_children())
-        query = f'SELECT COUNT(id) FROM news WHERE recycled == 0 AND read == 0 AND feed_id IN {feed_ids}'
-        return self.bringdb.select_one(query)[0]
+        '''
+        Return the number of unread news in this feed and its descendants.
+        '''
+        counts = self.bringdb.get_feed_unread_counts()
+        return sum(counts.get(feed_id, 0) for feed_id in self.get_subtree_ids())
+
+    def _high_water_checker(self):
+        '''
+        Return the is_known function for feedparse.parse_feed, which checks
+        entries against this feed's high water mark, or None if this refresh
+        should parse the whole document.
+        '''
+        if constants.HIGH_WATER_KNOWN_RUN is None:
+            return None
+
+        if not self.high_water_guids or self.last_full_ingest is None:
+            return None
+
+        if helpers.now() - self.last_full_ingest >= constants.HIGH_WATER_VERIFY_INTERVAL:
+            log.debug('%s is due for a full parse.', self)
+            return None
+
+        high_water = set(self.high_water_guids)
+        def is_known(kind, entry):
+            try:
+                guid = self.bringdb.entry_guid(kind, entry, self)
+            except Exception:
+                # The ingest will raise the problem properly, we just need to
+                # make sure we don't stop before reaching it.
+                return False
+            return guid in high_water
+
+        return is_known
 
     def is_ancestor(self, other):
         return any(self == ancestor for ancestor in other.walk_parents())
@@ -248,7 +547,12 @@ class Feed(ObjectBase):
         j = {
             'type': 'feed',
             'id': self.id,
+            'adaptive_interval': self.adaptive_interval,
+            'adaptive_interval_max': self.adaptive_interval_max,
+            'adaptive_interval_min': self.adaptive_interval_min,
+            'adaptive_refresh': self.adaptive_refresh,
             'autorefresh_interval': self.autorefresh_interval,
+            'circuit_breaker_tripped': self.circuit_breaker_tripped,
             'created': self.created,
             'description': self.description,
             'display_name': self.display_name,
@@ -258,6 +562,8 @@ class Feed(ObjectBase):
             'last_refresh_attempt': self.last_refresh_attempt,
             'last_refresh_error': self.last_refresh_error,
             'parent_id': self.parent_id,
+            'refresh_failures': self.refresh_failures,
+            'refresh_not_before': self.refresh_not_before,
             'rss_url': self.rss_url,
             'title': self.title,
             'ui_order_rank': self.ui_order_rank,
@@ -295,18 +601,29 @@ class Feed(ObjectBase):
         if self.autorefresh_interval < 1:
             return float('inf')
 
-        # Consideration: we could add special logic so that if the previous
-        # attempt failed, we don't wait the full interval to try again. For
-        # example, a feed you refresh every day could suddenly become two days
-        # late just because of a temporary 503 issue. We could make it so that
-        # there is a short initial retry at an hour or so, then exponential
-        # backoff until reaching the regularly scheduled interval. But this will
-        # require persisting the number of failures in a row and I don't want to
-        # pollute the db scheme with stuff like this. Perhaps it could be an
-        # in-memory only attribute on the assumption that the daemon is
-        # long-running anyway, to the detriment of cronjob based refreshes.
+        if self.circuit_breaker_tripped:
+            return float('inf')
+
+        interval = self.autorefresh_interval
+        if self.adaptive_refresh and self.adaptive_interval is not None:
+            interval = self.adaptive_interval
+
+        # If the previous attempt failed, we don't wait the full interval to
+        # try again. Otherwise a feed you refresh every day could suddenly
+        # become two days late just because of a temporary 503 issue. There is
+        # a short initial retry, then exponential backoff until reaching the
+        # regularly scheduled interval.
+        if self.refresh_failures > 0:
+            backoff = constants.REFRESH_FIRST_RETRY * (2 ** (self.refresh_failures - 1))
+            interval = min(interval, backoff)
 
-        return self.last_refresh_attempt + self.autorefresh_interval
+        next_refresh = self.last_refresh_attempt + interval
+
+        # The origin can push this later, but not earlier, than our interval.
+        if self.refresh_not_before is not None:
+            next_refresh = max(next_refresh, self.refresh_not_before)
+
+        return next_refresh
 
     @property
     def parent(self):
@@ -318,113 +635,92 @@ class Feed(ObjectBase):
 
         return self._parent
 
-    def _refresh_feed_properties_atom(self, soup):
-        feed = soup.find('feed')
+    def predict_adaptive_interval(self, *, count, oldest, now) -> int:
+        '''
+        Given the number of news this feed published since the beginning of the
+        lookback period and the publish timestamp of the oldest of them, return
+        the refresh interval clamped to this feed's bounds.
+
+        The average gap between news is measured up to now rather than up to
+        the newest news, so a feed that has gone quiet gets a longer interval
+        as time passes. We refresh twice per gap so that new news don't wait a
+        whole gap to be seen.
+        '''
+        minimum = self.adaptive_interval_min or constants.ADAPTIVE_INTERVAL_MIN
+        maximum = self.adaptive_interval_max or constants.ADAPTIVE_INTERVAL_MAX
+        # The feed's own minimum could be above the default maximum.
+        maximum = max(minimum, maximum)
+
+        if count == 0:
+            return maximum
 
-        if not feed:
-            raise ValueError('No feed element!')
+        gap = (now - oldest) / count
+        interval = int(gap / 2)
+        return min(max(interval, minimum), maximum)
 
+    def _refresh_feed_properties_atom(self, parsed):
         if not self.title:
-            title = feed.find('title')
+            title = parsed.title
             if title is not None:
-                title = title.text.strip()
+                title = title.strip()
                 if title:
                     self.set_title(title)
 
         if not self.description:
-            description = feed.find('subtitle')
+            description = parsed.description
             if description is not None:
-                description = description.text.strip()
+                description = description.strip()
                 if description:
                     self.set_description(description)
 
         if not self.web_url:
-            web_url = helpers.pick_web_url_atom(feed)
+            web_url = helpers.pick_web_url_atom(parsed.atom_links)
             if web_url != self.web_url:
                 self.set_web_url(web_url)
 
-    def _refresh_feed_properties_rss(self, soup):
-        rss = soup.find('rss')
-
-        if not rss:
-            raise ValueError('No rss element!')
-
-        channel = rss.find('channel')
-
-        if not channel:
-            raise ValueError('No channel element!')
-
+    def _refresh_feed_properties_rss(self, parsed):
         if not self.title:
-            title = channel.find('title')
+            title = parsed.title
             if title is not None:
-                title = title.text.strip()
+                title = title.strip()
                 if title:
                     self.set_title(title)
 
         if not self.description:
-            description = channel.find('description')
+            description = parsed.description
             if description is not None:
-                description = description.text.strip()
+                description = description.strip()
                 if description:
                     self.set_description(description)
 
         if not self.web_url:
-            web_url = channel.find('link')
+            web_url = parsed.rss_link
             if web_url is not None:
-                web_url = web_url.text.strip()
+                web_url = web_url.strip()
                 if web_url:
                     self.set_web_url(web_url)
 
-    @worms.atomic
-    def _refresh(self):
-        soup = helpers.fetch_xml_cached(self.rss_url, headers=self.http_headers)
-
-        if helpers.xml_is_atom(soup):
-            self._refresh_feed_properties_atom(soup)
-        elif helpers.xml_is_rss(soup):
-            self._refresh_feed_properties_rss(soup)
-        else:
-            raise exceptions.NeitherAtomNorRSS(self.rss_url)
-
-        if not self.icon:
-            self._set_icon_by_domain_favicon()
-
-        self.bringdb.ingest_news_xml(soup, feed=self)
-        self.last_refresh = int(helpers.now())
-        pairs = {
-            'id': self.id,
-            'last_refresh': self.last_refresh,
-        }
-        self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
-
-    @worms.atomic
     def refresh(self):
-        if not self.rss_url:
-            self.clear_last_refresh_error()
-            return
+        '''
+        Fetch this feed and ingest its news.
 
-        self.assert_not_deleted()
+        The network requests are made with no transaction open, and then a
+        transaction is opened just for writing the results. Because of this,
+        you should not call this method while you already have a transaction
+        open. Use fetch and apply_fetch if you need to control the transaction
+        yourself.
 
-        log.info('Refreshing %s', self)
-        self.last_refresh_attempt = int(helpers.now())
+        If the refresh fails, the exception is raised after the failure has
+        been recorded in last_refresh_error.
+        '''
+        fetch = self.fetch()
 
-        try:
-            self._refresh()
-            self.last_refresh_error = None
-            ret = None
-        except Exception as exc:
-            self.last_refresh_error = traceback.format_exc()
-            ret = worms.raise_without_rollback(exc)
+        with self.bringdb.transaction:
+            self.apply_fetch(fetch)
 
-        pairs = {
-            'id': self.id,
-            'last_refresh_attempt': self.last_refresh_attempt,
-            'last_refresh_error': self.last_refresh_error,
-        }
-        self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
-        return ret
+        if fetch.exception is not None:
+            raise fetch.exception
 
-    @worms.atomic
     def refresh_all(self):
         '''
         Refresh this feed and all of its descendants, except the ones with
@@ -441,6 +737,51 @@ class Feed(ObjectBase):
             except Exception:
                 log.warning(traceback.format_exc())
 
+    @worms.atomic
+    def _set_adaptive_interval(self, adaptive_interval):
+        pairs = {
+            'id': self.id,
+            'adaptive_interval': adaptive_interval,
+        }
+        self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
+        self.adaptive_interval = adaptive_interval
+
+    @worms.atomic
+    def set_adaptive_interval_bounds(self, minimum, maximum):
+        '''
+        Set the shortest and longest interval that adaptive refresh may choose
+        for this feed. None means to use constants.ADAPTIVE_INTERVAL_MIN / MAX.
+        '''
+        self.assert_not_deleted()
+        minimum = self.normalize_adaptive_interval_bound(minimum)
+        maximum = self.normalize_adaptive_interval_bound(maximum)
+
+        if minimum is not None and maximum is not None and minimum > maximum:
+            raise ValueError(f'minimum {minimum} should be <= maximum {maximum}.')
+
+        pairs = {
+            'id': self.id,
+            'adaptive_interval_min': minimum,
+            'adaptive_interval_max': maximum,
+        }
+        self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
+        self.adaptive_interval_min = minimum
+        self.adaptive_interval_max = maximum
+        self.bringdb.update_adaptive_intervals([self])
+
+    @worms.atomic
+    def set_adaptive_refresh(self, adaptive_refresh):
+        self.assert_not_deleted()
+        adaptive_refresh = self.normalize_adaptive_refresh(adaptive_refresh)
+
+        pairs = {
+            'id': self.id,
+            'adaptive_refresh': adaptive_refresh,
+        }
+        self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
+        self.adaptive_refresh = adaptive_refresh
+        self.bringdb.update_adaptive_intervals([self])
+
     @worms.atomic
     def set_autorefresh_interval(self, autorefresh_interval):
         self.assert_not_deleted()
@@ -465,20 +806,6 @@ class Feed(ObjectBase):
         self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
         self.description = description
 
-    def _set_icon_by_domain_favicon(self):
-        parts = urllib.parse.urlsplit(self.rss_url)
-
-        for path in ['/favicon.ico', '/favicon.png']:
-            url = urllib.parse.urlunsplit(parts._replace(path=path, query='', fragment=''))
-            log.debug('Trying favicon %s', url)
-            response = constants.http_session.get(url)
-            if response.ok:
-                try:
-                    self.set_icon(response.content)
-                    return self.icon
-                except Exception:
-                    log.warning(traceback.format_exc())
-
     @worms.atomic
     def set_filters(self, filters):
         self.assert_not_deleted()
@@ -504,6 +831,50 @@ class Feed(ObjectBase):
             }
             self.bringdb.insert(table='feed_filter_rel', pairs=data)
 
+        # The filters apply to the news of all descendants.
+        self.bringdb.clear_ingest_caches(self.walk_children())
+
+    @worms.atomic
+    def _set_high_water_mark(self, entries, *, complete):
+        '''
+        Called by ingest_parsed_feed with the (guid, published) of each entry
+        that was parsed, in document order.
+
+        The guids are remembered only if every entry has a published date and
+        the entries are ordered newest first, because otherwise the new news
+        could be anywhere in the document and we must always parse the whole
+        thing. Entries without a date can't show us the order, so a document
+        with few or no dates would otherwise look newest first.
+        '''
+        published = [entry_published for (guid, entry_published) in entries]
+        if all(published):
+            newest_first = all(a >= b for (a, b) in zip(published, published[1:]))
+        else:
+            newest_first = False
+
+        if not newest_first:
+            high_water_guids = None
+        elif complete:
+            high_water_guids = [guid for (guid, entry_published) in entries]
+        else:
+            high_water_guids = [guid for (guid, entry_published) in entries]
+            high_water_guids.extend(self.high_water_guids or [])
+
+        if high_water_guids is not None:
+            high_water_guids = list(dict.fromkeys(high_water_guids))
+            high_water_guids = high_water_guids[:constants.HIGH_WATER_SIZE]
+
+        pairs = {
+            'id': self.id,
+            'high_water_guids': None if high_water_guids is None else json.dumps(high_water_guids),
+        }
+        if complete:
+            self.last_full_ingest = int(helpers.now())
+            pairs['last_full_ingest'] = self.last_full_ingest
+
+        self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
+        self.high_water_guids = high_water_guids
+
     @worms.atomic
     def set_http_headers(self, http_headers):
         self.assert_not_deleted()
@@ -515,6 +886,8 @@ class Feed(ObjectBase):
         }
         self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
         self.http_headers = http_headers
+        # The old validators were issued for a different request.
+        self.clear_refresh_cache()
 
     @worms.atomic
     def set_icon(self, icon:bytes):
@@ -543,12 +916,21 @@ class Feed(ObjectBase):
             'original_feed_id': self.id,
         }
         if isolate_guids:
-            pairs['rss_guid'] = sqlhelpers.Inject(f'"_isolate_{self.id}_"||rss_guid')
+            rss_guid = f'"_isolate_{self.id}_"||rss_guid'
         else:
-            pairs['rss_guid'] = sqlhelpers.Inject(f'REPLACE(rss_guid, "_isolate_{self.id}_", "")')
+            rss_guid = f'REPLACE(rss_guid, "_isolate_{self.id}_", "")'
+        pairs['rss_guid'] = sqlhelpers.Inject(rss_guid)
+        # hash_guid is registered on the connection by BringDB. In an UPDATE,
+        # the column refers to the old value, so we repeat the expression.
+        pairs['guid_hash'] = sqlhelpers.Inject(f'hash_guid({rss_guid})')
 
         self.bringdb.update(table=News, pairs=pairs, where_key='original_feed_id')
         self.isolate_guids = isolate_guids
+        # Changing the guids changes which news are duplicates of which, not
+        # only for this feed but for any feed that shares guids with it.
+        feeds = set(self.bringdb.get_feeds_sharing_guids())
+        feeds.add(self)
+        self.bringdb.clear_ingest_caches(feeds)
 
     @worms.atomic
     def set_parent(self, parent, ui_order_rank=None):
@@ -563,7 +945,7 @@ class Feed(ObjectBase):
             if parent == self:
                 raise TypeError(parent)
 
-            if parent in list(self.walk_children()):
+            if parent.id in self.get_subtree_ids():
                 raise TypeError(parent)
 
             parent.assert_not_deleted()
@@ -580,6 +962,9 @@ class Feed(ObjectBase):
             self.ui_order_rank = ui_order_rank
 
         self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
+        feed_tree = self.bringdb.get_feed_tree()
+        feed_tree.set_parent(self.id, parent_id)
+        feed_tree.set_ui_order_rank(self.id, self.ui_order_rank)
         self.bringdb.reassign_ui_order_ranks()
         self.parent_id = parent_id
 
@@ -603,12 +988,17 @@ class Feed(ObjectBase):
         self.assert_not_deleted()
         rss_url = self.normalize_rss_url(rss_url)
 
+        # The new url deserves a fresh start if the old one was failing.
         pairs = {
             'id': self.id,
             'rss_url': rss_url,
+            'refresh_failures': 0,
         }
         self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
         self.rss_url = rss_url
+        self.refresh_failures = 0
+        # The old validators were issued for a different url.
+        self.clear_refresh_cache()
 
     @worms.atomic
     def set_title(self, title):
@@ -632,6 +1022,7 @@ class Feed(ObjectBase):
             'ui_order_rank': ui_order_rank,
         }
         self.bringdb.update(table=Feed, pairs=pairs, where_key='id')
+        self.bringdb.get_feed_tree().set_ui_order_rank(self.id, ui_order_rank)
         self.ui_order_rank = ui_order_rank
 
     @worms.atomic
@@ -682,10 +1073,77 @@ class Feed(ObjectBase):
         if yield_self:
             yield self
 
-        current = self.parent
-        while current is not None:
-            yield current
-            current = current.parent
+        ancestor_ids = self.bringdb.get_feed_tree().get_ancestors(self.id)
+        yield from self.bringdb.get_feeds_by_id_ordered(ancestor_ids)
+
+class FeedFetch:
+    '''
+    The result of Feed.fetch, to be passed into Feed.apply_fetch. This holds
+    everything that was downloaded from the network so that the database
+    writes can happen separately.
+    '''
+    def __init__(self, feed):
+        self.feed = feed
+        self.attempted = int(helpers.now())
+        self.parsed = None
+        self.icon = None
+        self.status_code = None
+        self.bytes = 0
+        self.duration = 0
+        # True if the server responded 304 or sent a document with the same
+        # content_hash as the last one that was ingested. Then parsed is None.
+        self.unchanged = False
+        self.content_hash = None
+        self.etag = None
+        self.last_modified = None
+        # Timestamp before which the origin asked us not to refresh again.
+        self.not_before = None
+        # If the fetch fails, exception is the exception object and error is
+        # the formatted traceback for last_refresh_error.
+        self.exception = None
+        self.error = None
+        # Filled in by Feed.apply_fetch with the news that were new.
+        self.newss = []
+
+    def __repr__(self):
+        return f'FeedFetch:{self.feed.id}'
+
+    def defer(self, seconds):
+        '''
+        Record that the origin asked us to wait this many seconds before the
+        next refresh, capped at constants.MAX_REFRESH_DEFERRAL. None or 0 is
+        ignored.
+        '''
+        if not seconds:
+            return
+        seconds = min(seconds, constants.MAX_REFRESH_DEFERRAL)
+        self.not_before = int(self.attempted + seconds)
+
+    @property
+    def status(self):
+        if not self.feed.rss_url:
+            return 'skipped'
+        if self.exception is not None:
+            return 'error'
+        if self.unchanged and self.status_code == 304:
+            return 'not_modified'
+        if self.unchanged:
+            return 'unchanged'
+        return 'ok'
+
+    def jsonify(self):
+        j = {
+            'type': 'feed_fetch',
+            'feed_id': self.feed.id,
+            'rss_url': self.feed.rss_url,
+            'status': self.status,
+            'status_code': self.status_code,
+            'bytes': self.bytes,
+            'duration': round(self.duration, 3),
+            'new_items': len(self.newss),
+            'error': None if self.exception is None else repr(self.exception),
+        }
+        return j
 
 class Filter(ObjectBase):
     table = 'filters'
@@ -1038,6 +1496,22 @@ class Filter(ObjectBase):
 
         return (function, validator)
 
+    @worms.atomic
+    def _clear_ingest_caches_of_users(self):
+        '''
+        The feeds that use this filter, and their descendants, must ingest
+        their next document in full so the edited filter gets a chance to see
+        it.
+        '''
+        feed_ids = self.bringdb.select_column(
+            'SELECT feed_id FROM feed_filter_rel WHERE filter_id == ?',
+            [self.id],
+        )
+        feeds = set()
+        for feed in self.bringdb.get_feeds_by_id(list(feed_ids)):
+            feeds.update(feed.walk_children())
+        self.bringdb.clear_ingest_caches(feeds)
+
     @staticmethod
     def _parse_stored_condition(token, run_validator):
         return Filter._parse_stored(token, 'condition', run_validator=run_validator)
@@ -1156,6 +1630,7 @@ class Filter(ObjectBase):
         self.bringdb.update(table=Filter, pairs=pairs, where_key='id')
         self._actions = actions
         self.actions = self.parse_actions(actions)
+        self._clear_ingest_caches_of_users()
 
     @worms.atomic
     def set_conditions(self, conditions:str):
@@ -1171,6 +1646,7 @@ class Filter(ObjectBase):
         self.bringdb.update(table=Filter, pairs=pairs, where_key='id')
         self._conditions = conditions
         self.conditions = self.parse_conditions(conditions)
+        self._clear_ingest_caches_of_users()
 
     @worms.atomic
     def set_name(self, name):
@@ -1188,6 +1664,32 @@ class News(ObjectBase):
     table = 'news'
     no_such_exception = exceptions.NoSuchNews
 
+    # Up to 20,000 News are kept in the cache, so they should be small. The
+    # text is left in the database until it is asked for, and the authors and
+    # enclosures are kept as their JSON until they are asked for. worms.Object
+    # doesn't have slots, so there is still a small __dict__ holding its
+    # _worms_database and deleted, but everything else goes in the slots.
+    __slots__ = (
+        'id',
+        'feed_id',
+        'original_feed_id',
+        'rss_guid',
+        'updated',
+        'title',
+        'web_url',
+        'comments_url',
+        'created',
+        'read',
+        'recycled',
+        'published_unix',
+        '_authors',
+        '_enclosures',
+        '_feed',
+        '_text',
+    )
+
+    NOT_LOADED = sentinel.Sentinel('not_loaded')
+
     def __init__(self, bringdb, db_row):
         super().__init__(bringdb)
 
@@ -1197,27 +1699,18 @@ class News(ObjectBase):
         self.rss_guid = db_row['rss_guid']
         self.updated = db_row['updated']
         self.title = db_row['title']
-        self.text = db_row['text']
         self.web_url = db_row['web_url']
         self.comments_url = db_row['comments_url']
         self.created = db_row['created']
         self.read = db_row['read']
         self.recycled = db_row['recycled']
-
         self.published_unix = db_row['published']
-        # utcfromtimestamp doesn't like negative numbers, but timedelta can
-        # handle it, so this does better than just calling
-        # utcfromtimestamp(published)
-        self.published = datetime.datetime.utcfromtimestamp(0) + datetime.timedelta(seconds=self.published_unix)
 
-        if db_row['authors']:
-            self.authors = json.loads(db_row['authors'])
-        else:
-            self.authors = []
-        if db_row['enclosures']:
-            self.enclosures = json.loads(db_row['enclosures'])
-        else:
-            self.enclosures = []
+        # Decoded by the properties on first access.
+        self._authors = db_row['authors']
+        self._enclosures = db_row['enclosures']
+        # Selected by the text property on first access.
+        self._text = News.NOT_LOADED
 
         self._feed = None
 
@@ -1227,6 +1720,16 @@ class News(ObjectBase):
         else:
             return f'News:{self.id}'
 
+    @staticmethod
+    def make_cursor(published, id) -> str:
+        '''
+        Return the listing cursor for the news with this published and id.
+        See BringDB.get_newss.
+        '''
+        cursor = json.dumps([published, id], separators=(',', ':'))
+        cursor = base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+        return cursor
+
     normalize_author_name = helpers.normalize_string_blank_to_none
 
     normalize_author_email = helpers.normalize_string_blank_to_none
@@ -1310,7 +1813,7 @@ class News(ObjectBase):
             return published
 
         if isinstance(published, str):
-            return helpers.dateutil_parse(published).timestamp()
+            return helpers.parse_timestamp(published)
 
         raise TypeError(published)
 
@@ -1340,12 +1843,48 @@ class News(ObjectBase):
             return updated
 
         if isinstance(updated, str):
-            return helpers.dateutil_parse(updated).timestamp()
+            return helpers.parse_timestamp(updated)
 
         raise TypeError(updated)
 
     normalize_web_url = helpers.normalize_string_blank_to_none
 
+    @staticmethod
+    def parse_cursor(cursor:str) -> tuple:
+        '''
+        Return the (published, id) of a cursor from make_cursor, or raise
+        exceptions.InvalidCursor.
+        '''
+        try:
+            (published, id) = json.loads(base64.urlsafe_b64decode(cursor))
+        except Exception:
+            raise exceptions.InvalidCursor(cursor)
+
+        if not isinstance(published, (int, float)) or not isinstance(id, int):
+            raise exceptions.InvalidCursor(cursor)
+
+        return (published, id)
+
+    @property
+    def authors(self) -> list:
+        if self._authors is None:
+            self._authors = []
+        elif isinstance(self._authors, str):
+            self._authors = json.loads(self._authors)
+        return self._authors
+
+    @property
+    def cursor(self) -> str:
+        return self.make_cursor(self.published_unix, self.id)
+
+    @property
+    def enclosures(self) -> list:
+        if self._enclosures is None:
+            self._enclosures = []
+        elif isinstance(self._enclosures, str):
+            self._enclosures = json.loads(self._enclosures)
+        return self._enclosures
+
     @property
     def feed(self):
         if self._feed is None:
@@ -1392,14 +1931,25 @@ class News(ObjectBase):
 
         log.debug('Moving %s to %s.', self, feed)
 
-        pairs = {
-            'id': self.id,
-            'feed_id': feed.id,
-        }
-        self.bringdb.update(table=News, pairs=pairs, where_key='id')
+        # The counters are adjusted from the row as it is in the database, not
+        # from our attributes, which may be stale. The guard on the update
+        # makes sure the move is counted only if it actually happened.
+        query = 'SELECT feed_id, read, recycled FROM news WHERE id == ?'
+        (old_feed_id, read, recycled) = self.bringdb.select_one(query, [self.id])
+        query = 'UPDATE news SET feed_id = ? WHERE id == ? AND feed_id != ?'
+        cur = self.bringdb.execute(query, [feed.id, self.id, feed.id])
+        if cur.rowcount == 1 and not read and not recycled:
+            self.bringdb._adjust_unread_counts({old_feed_id: -1, feed.id: 1})
         self.feed_id = feed.id
         self._feed = None
 
+    @property
+    def published(self) -> datetime.datetime:
+        # utcfromtimestamp doesn't like negative numbers, but timedelta can
+        # handle it, so this does better than just calling
+        # utcfromtimestamp(published)
+        return datetime.datetime.utcfromtimestamp(0) + datetime.timedelta(seconds=self.published_unix)
+
     @property
     def published_string(self):
         published = self.published.strftime('%Y-%m-%d %H:%M')
@@ -1414,11 +1964,13 @@ class News(ObjectBase):
         self.assert_not_deleted()
         read = self.normalize_read(read)
 
-        pairs = {
-            'id': self.id,
-            'read': read,
-        }
-        self.bringdb.update(table=News, pairs=pairs, where_key='id')
+        # See move_to_feed about the counters.
+        query = 'SELECT feed_id, recycled FROM news WHERE id == ?'
+        (feed_id, recycled) = self.bringdb.select_one(query, [self.id])
+        query = 'UPDATE news SET read = ? WHERE id == ? AND read != ?'
+        cur = self.bringdb.execute(query, [read, self.id, read])
+        if cur.rowcount == 1 and not recycled:
+            self.bringdb._adjust_unread_counts({feed_id: -1 if read else 1})
         self.read = read
 
     @worms.atomic
@@ -1426,9 +1978,18 @@ class News(ObjectBase):
         self.assert_not_deleted()
         recycled = self.normalize_recycled(recycled)
 
-        pairs = {
-            'id': self.id,
-            'recycled': recycled,
-        }
-        self.bringdb.update(table=News, pairs=pairs, where_key='id')
+        # See move_to_feed about the counters.
+        query = 'SELECT feed_id, read FROM news WHERE id == ?'
+        (feed_id, read) = self.bringdb.select_one(query, [self.id])
+        query = 'UPDATE news SET recycled = ? WHERE id == ? AND recycled != ?'
+        cur = self.bringdb.execute(query, [recycled, self.id, recycled])
+        if cur.rowcount == 1 and not read:
+            self.bringdb._adjust_unread_counts({feed_id: -1 if recycled else 1})
         self.recycled = recycled
+
+    @property
+    def text(self):
+        if self._text is News.NOT_LOADED:
+            query = 'SELECT text FROM news WHERE id == ?'
+            self._text = self.bringdb.select_one_value(query, [self.id])
+        return self._text
@@ -1,5 +1,9 @@
 import argparse
+import concurrent.futures
+import json
 import sys
+import textwrap
+import time
 
 from voussoirkit import betterhelp
 from voussoirkit import hms
@@ -18,8 +22,72 @@ def load_bringdb():
         return
     bringdb = bringrss.bringdb.BringDB.closest_bringdb()
 
+def refresh_feeds(feeds, *, workers=1, batch_size=20):
+    '''
+    Download the feeds using a pool of worker threads, and write the results
+    to the database in transactions of up to batch_size feeds each. Only the
+    main thread touches the database.
+
+    Returns a summary dict with the results of each feed.
+    '''
+    start = time.monotonic()
+    fetches = []
+    batch = []
+
+    def write_batch():
+        with bringdb.transaction:
+            for fetch in batch:
+                fetch.feed.apply_fetch(fetch)
+
+        for fetch in batch:
+            if fetch.exception is not None:
+                log.warning('Refreshing %s encountered:\n%s', fetch.feed, fetch.error)
+        batch.clear()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # Interleave the hosts so the workers aren't all waiting on the
+        # politeness limit of the same host.
+        feeds = bringrss.hostlimiter.round_robin_by_host(feeds)
+        futures = [pool.submit(feed.fetch) for feed in feeds]
+        for future in concurrent.futures.as_completed(futures):
+            fetch = future.result()
+            fetches.append(fetch)
+            batch.append(fetch)
+            if len(batch) >= batch_size:
+                write_batch()
+
+    if batch:
+        write_batch()
+
+    with bringdb.transaction:
+        bringdb.update_adaptive_intervals()
+
+    results = [fetch.jsonify() for fetch in fetches]
+    summary = {
+        'feeds': results,
+        'refreshed': len(results),
+        'errors': sum(result['status'] == 'error' for result in results),
+        'new_items': sum(result['new_items'] for result in results),
+        'bytes': sum(result['bytes'] for result in results),
+        'wall_time': round(time.monotonic() - start, 3),
+    }
+    return summary
+
 ####################################################################################################
 
+def check_query_plans_argparse(args):
+    load_bringdb()
+    results = bringdb.check_query_plans()
+    for result in results:
+        status = 'ok' if result['ok'] else 'BAD'
+        pipeable.stdout(f'{status}: {result["description"]}, expected {result["expected"]}')
+        if not result['ok'] or args.verbose_plans:
+            pipeable.stdout(textwrap.indent(result['plan'], '    '))
+
+    if all(result['ok'] for result in results):
+        return 0
+    return 1
+
 def init_argparse(args):
     bringdb = bringrss.bringdb.BringDB(create=True)
     return 0
@@ -28,13 +96,17 @@ def refresh_argparse(args):
     load_bringdb()
     now = bringrss.helpers.now()
     soonest = float('inf')
-    with bringdb.transaction:
-        for feed in list(bringdb.get_feeds()):
-            next_refresh = feed.next_refresh
-            if now > next_refresh:
-                feed.refresh()
-            elif next_refresh < soonest:
-                soonest = next_refresh
+    feeds = []
+    for feed in list(bringdb.get_feeds()):
+        next_refresh = feed.next_refresh
+        if now > next_refresh:
+            feeds.append(feed)
+        elif next_refresh < soonest:
+            soonest = next_refresh
+
+    summary = refresh_feeds(feeds, workers=args.workers, batch_size=args.batch_size)
+    pipeable.stdout(json.dumps(summary, indent=4))
+
     if soonest != float('inf'):
         soonest = hms.seconds_to_hms_letters(soonest - now)
         pipeable.stderr(f'The next soonest is in {soonest}.')
@@ -42,9 +114,29 @@ def refresh_argparse(args):
 
 def refresh_all_argparse(args):
     load_bringdb()
+    feeds = list(bringdb.get_feeds())
+    summary = refresh_feeds(feeds, workers=args.workers, batch_size=args.batch_size)
+    pipeable.stdout(json.dumps(summary, indent=4))
+    return 0
+
+def unread_counts_argparse(args):
+    load_bringdb()
+    mismatches = bringdb.verify_unread_counts()
+    for mismatch in mismatches:
+        feed = bringdb.get_feed(mismatch['feed_id'])
+        pipeable.stdout(f'{feed}: stored {mismatch["stored"]}, actual {mismatch["actual"]}')
+
+    if not mismatches:
+        pipeable.stderr('The unread counts are correct.')
+        return 0
+
+    if not args.rebuild:
+        return 1
+
     with bringdb.transaction:
-        for feed in list(bringdb.get_feeds()):
-            feed.refresh()
+        bringdb.rebuild_unread_counts()
+    pipeable.stderr(f'Rebuilt the unread counts, {len(mismatches)} were wrong.')
+    return 0
 
 @operatornotify.main_decorator(subject='bringrss_cli')
 @vlogging.main_decorator
@@ -58,6 +150,25 @@ def main(argv):
 
     subparsers = parser.add_subparsers()
 
+    p_check_query_plans = subparsers.add_parser(
+        'check_query_plans',
+        aliases=['check-query-plans'],
+        description='''
+        Run EXPLAIN QUERY PLAN on the queries behind the news listings and
+        unread counts, and check that each one uses the index that was designed
+        for it. Exits with status 1 if any of them doesn't.
+        ''',
+    )
+    p_check_query_plans.add_argument(
+        '--verbose_plans',
+        '--verbose-plans',
+        action='store_true',
+        help='''
+        Print the plan of every query, not just the bad ones.
+        ''',
+    )
+    p_check_query_plans.set_defaults(func=check_query_plans_argparse)
+
     p_init = subparsers.add_parser(
         'init',
         description='''
@@ -71,6 +182,27 @@ def main(argv):
         description='''
         Refresh feeds if their autorefresh interval has elapsed since their
         last refresh.
+
+        When finished, a JSON summary of each feed's duration, download size,
+        new items and status is written to stdout.
+        ''',
+    )
+    p_refresh.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='''
+        Download this many feeds at the same time.
+        ''',
+    )
+    p_refresh.add_argument(
+        '--batch_size',
+        '--batch-size',
+        type=int,
+        default=20,
+        help='''
+        Commit the results to the database after this many feeds, so that the
+        database is never locked for too long.
         ''',
     )
     p_refresh.set_defaults(func=refresh_argparse)
@@ -80,10 +212,49 @@ def main(argv):
         aliases=['refresh-all'],
         description='''
         Refresh all feeds now.
+
+        When finished, a JSON summary of each feed's duration, download size,
+        new items and status is written to stdout.
+        ''',
+    )
+    p_refresh_all.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='''
+        Download this many feeds at the same time.
+        ''',
+    )
+    p_refresh_all.add_argument(
+        '--batch_size',
+        '--batch-size',
+        type=int,
+        default=20,
+        help='''
+        Commit the results to the database after this many feeds, so that the
+        database is never locked for too long.
         ''',
     )
     p_refresh_all.set_defaults(func=refresh_all_argparse)
 
+    p_unread_counts = subparsers.add_parser(
+        'unread_counts',
+        aliases=['unread-counts'],
+        description='''
+        Check the stored unread count of every feed against an actual count of
+        its news, and print the ones that are wrong. Exits with status 1 if any
+        of them are wrong, unless --rebuild is used.
+        ''',
+    )
+    p_unread_counts.add_argument(
+        '--rebuild',
+        action='store_true',
+        help='''
+        If any of the counts are wrong, recount all of them.
+        ''',
+    )
+    p_unread_counts.set_defaults(func=unread_counts_argparse)
+
     return betterhelp.go(parser, argv)
 
 if __name__ == '__main__':
@@ -4,6 +4,7 @@ Use bringrss_flask_dev.py or bringrss_flask_prod.py.
 '''
 import flask; from flask import request
 import functools
+import heapq
 import json
 import queue
 import threading
@@ -182,107 +183,305 @@ AUTOREFRESH_THREAD_EVENTS = queue.Queue()
 
 def autorefresh_thread():
     '''
-    This thread keeps an eye on the last_refresh and autorefresh_interval of all
-    the feeds, and puts the feeds into the REFRESH_QUEUE when they are ready.
-
-    When a feed is refreshed manually, we recalculate the schedule so it does
-    not autorefresh until another interval has elapsed.
+    This thread keeps an eye on the next_refresh of all the feeds, and puts the
+    feeds into the REFRESH_QUEUE when they are ready.
+
+    The schedule is a heap of (next_refresh, feed_id) so that the soonest feed
+    is always on top, and the thread sleeps until exactly that moment. The
+    database is only read once at startup. After that, whenever something
+    changes a feed's next_refresh (a finished refresh, a change of settings)
+    the feed should be passed to reschedule_autorefresh, which wakes this
+    thread up to update the heap.
     '''
     log.info('Starting autorefresh thread.')
+    heap = []
+    # {feed_id: next_refresh} for every feed that is currently scheduled. When a
+    # feed is rescheduled, its old heap entry is left in place and skipped when
+    # it comes up because it no longer matches this dict.
+    schedule = {}
+
+    def schedule_feed(feed):
+        next_refresh = float('inf') if feed.deleted else feed.next_refresh
+        if next_refresh == float('inf'):
+            schedule.pop(feed.id, None)
+            return
+
+        schedule[feed.id] = next_refresh
+        heapq.heappush(heap, (next_refresh, feed.id))
+
+    for feed in list(bringdb.get_feeds()):
+        schedule_feed(feed)
+
     while True:
-        if not REFRESH_QUEUE.empty():
-            time.sleep(10)
-            continue
         now = bringrss.helpers.now()
-        soonest = now + 3600
-        for feed in list(bringdb.get_feeds()):
-            next_refresh = feed.next_refresh
-            if now > next_refresh:
-                add_feed_to_refresh_queue(feed)
-                # If the refresh fails it'll try again in an hour, if it
-                # succeeds it'll be one interval. We'll know for sure later but
-                # this is when this auto thread will check and see.
-                next_refresh = now + feed.autorefresh_interval
-
-            soonest = min(soonest, next_refresh)
+        while heap and heap[0][0] <= now:
+            (next_refresh, feed_id) = heapq.heappop(heap)
+            if schedule.get(feed_id) != next_refresh:
+                continue
+
+            try:
+                feed = bringdb.get_feed(feed_id)
+            except bringrss.exceptions.NoSuchFeed:
+                del schedule[feed_id]
+                continue
+
+            # The feed will come back into the schedule through
+            # reschedule_autorefresh once its refresh has been written, or
+            # once clear_refresh_queue takes it back out of the queue.
+            if feed.deleted or add_feed_to_refresh_queue(feed):
+                del schedule[feed_id]
+
+        # Don't let the outdated entries pile up forever.
+        if len(heap) > 2 * len(schedule) + 100:
+            heap = [(next_refresh, feed_id) for (feed_id, next_refresh) in schedule.items()]
+            heapq.heapify(heap)
+
+        if heap:
+            sleepy = max(heap[0][0] - now, 0)
+            log.info(f'Sleeping {int(sleepy)} until next refresh.')
+        else:
+            sleepy = None
+            log.info('Sleeping until a feed is scheduled.')
 
-        now = bringrss.helpers.now()
-        sleepy = soonest - now
-        sleepy = max(sleepy, 30)
-        sleepy = min(sleepy, 7200)
-        sleepy = int(sleepy)
-        log.info(f'Sleeping {sleepy} until next refresh.')
         try:
             event = AUTOREFRESH_THREAD_EVENTS.get(timeout=sleepy)
-            if event is QUIT_EVENT:
-                break
         except queue.Empty:
-            pass
+            continue
+
+        if event is QUIT_EVENT:
+            break
+
+        schedule_feed(event)
+
+def reschedule_autorefresh(feed):
+    '''
+    Tell the autorefresh thread to recalculate this feed's next_refresh. Call
+    this after anything that changes the feed's schedule, including deleting it.
+    '''
+    AUTOREFRESH_THREAD_EVENTS.put(feed)
 
 ####################################################################################################
 
 REFRESH_QUEUE = queue.Queue()
 # The Queue objects cannot be iterated and do not support membership testing.
 # We use this set to prevent the same feed being queued up for refresh twice
-# at the same time.
+# at the same time. Feeds stay in the set until their results have been
+# written, so it also tells us when the whole batch is finished.
 _REFRESH_QUEUE_SET = set()
+_REFRESH_QUEUE_LOCK = threading.Lock()
+# Feeds whose host was at its politeness limit when they came off the queue
+# wait here, so that feeds from other hosts can go ahead of them. Guarded by
+# _REFRESH_QUEUE_LOCK.
+_REFRESH_WAITING = []
+# A fetch thread puts this in the REFRESH_QUEUE when it finishes a request
+# while feeds are waiting, so that a thread which is blocked on the queue
+# wakes up and checks whether their host has room now.
+_REFRESH_WAKE_EVENT = sentinel.Sentinel('refresh_wake')
+# Requests made outside of the fetch threads, like the icon of a new feed,
+# don't wake anybody up, so a full host is checked again after this many
+# seconds anyway.
+_REFRESH_WAITING_RECHECK = 5
+# The fetch threads put their FeedFetch results here for the write thread.
+REFRESH_WRITE_QUEUE = queue.Queue()
+
+# This many feeds can be downloading and parsing at the same time. The database
+# writes are still performed one at a time by refresh_write_thread.
+DEFAULT_REFRESH_WORKERS = 4
+
+def refresh_fetch_thread():
+    '''
+    Several of these threads handle the network half of Feed refreshing. Whether
+    the refresh was user-initiated by clicking on the "Refresh" / "Refresh all"
+    button, or server-initiated by the autorefresh timer, all actual refreshing
+    happens through here. Clients don't have to distinguish between responses
+    to their refresh request and server-initiated refreshes, they can just
+    always watch the SSE.
+
+    These threads do not write to the database. The results are passed along
+    to refresh_write_thread.
+    '''
+    log.info('Starting refresh_fetch thread.')
+    limiter = bringrss.constants.http_host_limiter
+    while True:
+        (feed, claimed_url) = _next_refresh_feed()
+        if feed is QUIT_EVENT:
+            # Pass it along so the sibling threads and the writer quit too.
+            REFRESH_QUEUE.put(QUIT_EVENT)
+            REFRESH_WRITE_QUEUE.put(QUIT_EVENT)
+            break
 
-def refresh_queue_thread():
+        try:
+            if feed.rss_url:
+                # Don't bother calculating unreads
+                flasktools.send_sse(
+                    event='feed_refresh_started',
+                    data=json.dumps(feed.jsonify(unread_count=False)),
+                )
+            # The fetch enters the limiter for the url we claimed without
+            # claiming a second request.
+            fetch = feed.fetch()
+        except Exception:
+            log.warning('Fetching %s encountered:\n%s', feed, traceback.format_exc())
+            _finish_refresh(feed)
+            continue
+        finally:
+            if claimed_url is not None:
+                limiter.release(claimed_url)
+                _wake_refresh_waiting()
+
+        REFRESH_WRITE_QUEUE.put(fetch)
+
+def _next_refresh_feed():
     '''
-    This thread handles all Feed refreshing and sends the results out via the
-    SSE channel. Whether the refresh was user-initiated by clicking on the
-    "Refresh" / "Refresh all" button, or server-initiated by the autorefresh
-    timer, all actual refreshing happens through here. This allows us to make
-    sure we only have one refresh going on at a time and clients don't have to
-    distinguish between responses to their refresh request and server-initiated
-    refreshes, they can just always watch the SSE.
+    Return (feed, claimed_url) for the next feed whose host has room for a
+    request. The request is claimed from the limiter by this thread in the
+    same step as checking for room, so two threads can't both take the last
+    one. The caller must release claimed_url when the fetch is done. It is
+    None if the feed has no rss_url, or for QUIT_EVENT.
+
+    Feeds whose host is busy are set aside in _REFRESH_WAITING and picked up
+    again once their host is ready.
     '''
-    def _refresh_one(feed):
-        if not feed.rss_url:
-            feed.clear_last_refresh_error()
-            return
+    limiter = bringrss.constants.http_host_limiter
+    while True:
+        timeout = None
+        with _REFRESH_QUEUE_LOCK:
+            for (index, feed) in enumerate(_REFRESH_WAITING):
+                url = feed.rss_url
+                if not url:
+                    return (_REFRESH_WAITING.pop(index), None)
+
+                ready_in = limiter.try_acquire(url)
+                if ready_in == 0:
+                    return (_REFRESH_WAITING.pop(index), url)
+                # If the host is full, we'll be woken up by
+                # _REFRESH_WAKE_EVENT when one of its requests finishes.
+                if ready_in is None:
+                    ready_in = _REFRESH_WAITING_RECHECK
+                timeout = ready_in if timeout is None else min(timeout, ready_in)
 
-        # Don't bother calculating unreads
-        flasktools.send_sse(
-            event='feed_refresh_started',
-            data=json.dumps(feed.jsonify(unread_count=False)),
-        )
         try:
-            feed.refresh()
-        except Exception as exc:
-            log.warning('Refreshing %s encountered:\n%s', feed, traceback.format_exc())
-        flasktools.send_sse(
-            event='feed_refresh_finished',
-            data=json.dumps(feed.jsonify(unread_count=True)),
-        )
+            feed = REFRESH_QUEUE.get(timeout=timeout)
+        except queue.Empty:
+            continue
+
+        if feed is _REFRESH_WAKE_EVENT:
+            continue
+
+        url = None if feed is QUIT_EVENT else feed.rss_url
+        if not url:
+            return (feed, None)
 
-    log.info('Starting refresh_queue thread.')
+        if limiter.try_acquire(url) == 0:
+            return (feed, url)
+
+        with _REFRESH_QUEUE_LOCK:
+            _REFRESH_WAITING.append(feed)
+
+def refresh_write_thread():
+    '''
+    This thread takes the results of refresh_fetch_thread and writes them to
+    the database, one short transaction per feed, then sends the results out
+    via the SSE channel. Having one writer means the refreshes never compete
+    with each other for the database lock, only with the user's requests.
+    '''
+    log.info('Starting refresh_write thread.')
     while True:
-        feed = REFRESH_QUEUE.get()
-        if feed is QUIT_EVENT:
+        fetch = REFRESH_WRITE_QUEUE.get()
+        if fetch is QUIT_EVENT:
             break
-        with bringdb.transaction:
-            _refresh_one(feed)
+
+        feed = fetch.feed
+        try:
+            with bringdb.transaction:
+                feed.apply_fetch(fetch)
+        except Exception:
+            log.warning('Applying %s encountered:\n%s', fetch, traceback.format_exc())
+            _finish_refresh(feed)
+            continue
+
+        if fetch.exception is not None:
+            log.warning('Refreshing %s encountered:\n%s', feed, fetch.error)
+
+        if feed.rss_url:
+            flasktools.send_sse(
+                event='feed_refresh_finished',
+                data=json.dumps(feed.jsonify(unread_count=True)),
+            )
+
+        finished = _finish_refresh(feed)
+        if finished:
+            # The adaptive intervals are computed in bulk, so we wait until the
+            # whole batch is in.
+            try:
+                with bringdb.transaction:
+                    changed = bringdb.update_adaptive_intervals()
+            except Exception:
+                log.warning('Updating adaptive intervals encountered:\n%s', traceback.format_exc())
+                continue
+            for feed in changed:
+                reschedule_autorefresh(feed)
+
+def _finish_refresh(feed):
+    '''
+    Returns True if this was the last feed in the refresh queue.
+    '''
+    reschedule_autorefresh(feed)
+
+    with _REFRESH_QUEUE_LOCK:
         _REFRESH_QUEUE_SET.discard(feed)
-        if REFRESH_QUEUE.empty():
-            flasktools.send_sse(event='feed_refresh_queue_finished', data='')
-            _REFRESH_QUEUE_SET.clear()
+        finished = len(_REFRESH_QUEUE_SET) == 0
+
+    if finished:
+        flasktools.send_sse(event='feed_refresh_queue_finished', data='')
+
+    return finished
 
 def add_feed_to_refresh_queue(feed):
+    '''
+    Returns True if the feed is in the refresh queue now, either because we
+    added it or because it was already there.
+    '''
     if site.demo_mode:
-        return
+        return False
 
-    if feed in _REFRESH_QUEUE_SET:
-        return
+    with _REFRESH_QUEUE_LOCK:
+        if feed in _REFRESH_QUEUE_SET:
+            return True
+        _REFRESH_QUEUE_SET.add(feed)
 
     log.debug('Adding %s to refresh queue.', feed)
     REFRESH_QUEUE.put(feed)
-    _REFRESH_QUEUE_SET.add(feed)
+    return True
 
 def clear_refresh_queue():
-    while not REFRESH_QUEUE.empty():
-        feed = REFRESH_QUEUE.get_nowait()
-    _REFRESH_QUEUE_SET.clear()
+    # Feeds that are already being fetched will finish normally and remove
+    # themselves from the set.
+    discarded = []
+    with _REFRESH_QUEUE_LOCK:
+        while not REFRESH_QUEUE.empty():
+            discarded.append(REFRESH_QUEUE.get_nowait())
+        discarded.extend(_REFRESH_WAITING)
+        _REFRESH_WAITING.clear()
+        for feed in discarded:
+            _REFRESH_QUEUE_SET.discard(feed)
+
+    for feed in discarded:
+        if feed is _REFRESH_WAKE_EVENT:
+            continue
+        if feed is QUIT_EVENT:
+            REFRESH_QUEUE.put(QUIT_EVENT)
+            continue
+        # The autorefresh thread took these feeds off its schedule when it
+        # queued them, so they have to go back.
+        reschedule_autorefresh(feed)
+
+def _wake_refresh_waiting():
+    with _REFRESH_QUEUE_LOCK:
+        waiting = len(_REFRESH_WAITING) > 0
+
+    if waiting:
+        REFRESH_QUEUE.put(_REFRESH_WAKE_EVENT)
 
 def sse_keepalive_thread():
     log.info('Starting SSE keepalive thread.')
@@ -316,7 +515,12 @@ def init_bringdb(*args, **kwargs):
 
         REFRESH_QUEUE.put(QUIT_EVENT)
 
-def start_background_threads():
+def start_background_threads(refresh_workers=DEFAULT_REFRESH_WORKERS):
+    if refresh_workers < 1:
+        raise ValueError(f'refresh_workers should be at least 1, not {refresh_workers}.')
+
     threading.Thread(target=autorefresh_thread, daemon=True).start()
-    threading.Thread(target=refresh_queue_thread, daemon=True).start()
+    for x in range(refresh_workers):
+        threading.Thread(target=refresh_fetch_thread, daemon=True).start()
+    threading.Thread(target=refresh_write_thread, daemon=True).start()
     threading.Thread(target=sse_keepalive_thread, daemon=True).start()
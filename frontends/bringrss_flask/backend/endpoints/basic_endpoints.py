@@ -1,4 +1,5 @@
 import flask; from flask import request
+import json
 
 from voussoirkit import flasktools
 from voussoirkit import stringtools
@@ -29,9 +30,40 @@ def get_newss_json(feed_id=None):
         feed = common.get_feed(feed_id, response_type='json')
     read = stringtools.truthystring(request.args.get('read', False))
     recycled = stringtools.truthystring(request.args.get('recycled', False))
-    newss = common.bringdb.get_newss(feed=feed, read=read, recycled=recycled)
-    response = [news.jsonify() for news in newss]
-    return flasktools.json_response(response)
+
+    # Without a limit, the response is the list of all the news. With a limit,
+    # it is one page of them, plus the cursor to pass as `after` to get the
+    # next page, or null if this was the last one.
+    # The cached_endpoint would swallow the status of a returned error
+    # response, so bad parameters abort instead.
+    limit = request.args.get('limit', None)
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            flask.abort(400)
+        if limit < 1:
+            flask.abort(400)
+
+    after = request.args.get('after', None)
+
+    (newss_json, next_cursor) = common.bringdb.get_newss_json(
+        feed=feed,
+        read=read,
+        recycled=recycled,
+        limit=limit,
+        after=after,
+    )
+    # The news are already JSON text, so the response is put together around
+    # them instead of going through json_response.
+    if limit is None:
+        response = newss_json
+    else:
+        response = f'{{"newss": {newss_json}, "next_cursor": {json.dumps(next_cursor)}}}'
+
+    response = flask.Response(response)
+    response.headers['Content-Type'] = 'application/json;charset=utf-8'
+    return response
 
 @site.route('/')
 @site.route('/feed/<feed_id>')
@@ -44,12 +44,12 @@ def post_feeds_add():
     # will come up blank, then get populated in the background, which is bad
     # ux. However, we need to commit first, because if the refresh fails we want
     # the user to be able to see the Feed in the ui and read its
-    # last_refresh_error message.
-    with common.bringdb.transaction:
-        try:
-            feed.refresh()
-        except Exception:
-            log.warning('Refreshing %s raised:\n%s', feed, traceback.format_exc())
+    # last_refresh_error message. The refresh opens its own transaction.
+    try:
+        feed.refresh()
+    except Exception:
+        log.warning('Refreshing %s raised:\n%s', feed, traceback.format_exc())
+    common.reschedule_autorefresh(feed)
 
     return flasktools.json_response(feed.jsonify())
 
@@ -76,6 +76,7 @@ def post_feed_delete(feed_id):
     with common.bringdb.transaction:
         feed = common.get_feed(feed_id, response_type='json')
         feed.delete()
+    common.reschedule_autorefresh(feed)
     return flasktools.json_response({})
 
 @site.route('/feed/<feed_id>/icon.png')
@@ -118,8 +119,42 @@ def get_feed_settings(feed_id):
         feed=feed,
         feed_filters=feed_filters,
         available_filters=available_filters,
+        adaptive_interval_min_default=bringrss.constants.ADAPTIVE_INTERVAL_MIN,
+        adaptive_interval_max_default=bringrss.constants.ADAPTIVE_INTERVAL_MAX,
     )
 
+@site.route('/feed/<feed_id>/set_adaptive_interval_bounds', methods=['POST'])
+def post_feed_set_adaptive_interval_bounds(feed_id):
+    # Blank or missing means use the default.
+    try:
+        minimum = int(request.form['minimum']) if request.form.get('minimum') else None
+        maximum = int(request.form['maximum']) if request.form.get('maximum') else None
+    except ValueError:
+        return flasktools.json_response({}, status=400)
+
+    feed = common.get_feed(feed_id, response_type='json')
+    try:
+        with common.bringdb.transaction:
+            feed.set_adaptive_interval_bounds(minimum, maximum)
+    except ValueError:
+        return flasktools.json_response({}, status=400)
+    common.reschedule_autorefresh(feed)
+    return flasktools.json_response(feed.jsonify())
+
+@site.route('/feed/<feed_id>/set_adaptive_refresh', methods=['POST'])
+@flasktools.required_fields(['adaptive_refresh'])
+def post_feed_set_adaptive_refresh(feed_id):
+    try:
+        adaptive_refresh = stringtools.truthystring(request.form['adaptive_refresh'])
+    except ValueError:
+        return flasktools.json_response({}, status=400)
+    feed = common.get_feed(feed_id, response_type='json')
+    if adaptive_refresh != feed.adaptive_refresh:
+        with common.bringdb.transaction:
+            feed.set_adaptive_refresh(adaptive_refresh)
+        common.reschedule_autorefresh(feed)
+    return flasktools.json_response(feed.jsonify())
+
 @site.route('/feed/<feed_id>/set_autorefresh_interval', methods=['POST'])
 @flasktools.required_fields(['autorefresh_interval'])
 def post_feed_set_autorefresh_interval(feed_id):
@@ -133,8 +168,7 @@ def post_feed_set_autorefresh_interval(feed_id):
     if autorefresh_interval != feed.autorefresh_interval:
         with common.bringdb.transaction:
             feed.set_autorefresh_interval(autorefresh_interval)
-        # Wake up the autorefresh thread so it can recalculate its schedule.
-        common.AUTOREFRESH_THREAD_EVENTS.put("wake up!")
+        common.reschedule_autorefresh(feed)
     return flasktools.json_response(feed.jsonify())
 
 @site.route('/feed/<feed_id>/set_filters', methods=['POST'])
@@ -153,6 +187,7 @@ def post_feed_set_http_headers(feed_id):
     with common.bringdb.transaction:
         feed = common.get_feed(feed_id, response_type='json')
         feed.set_http_headers(request.form['http_headers'])
+    common.reschedule_autorefresh(feed)
     return flasktools.json_response(feed.jsonify())
 
 @site.route('/feed/<feed_id>/set_icon', methods=['POST'])
@@ -217,6 +252,7 @@ def post_feed_set_rss_url(feed_id):
     if rss_url != feed.rss_url:
         with common.bringdb.transaction:
             feed.set_rss_url(rss_url)
+        common.reschedule_autorefresh(feed)
     return flasktools.json_response(feed.jsonify())
 
 @site.route('/feed/<feed_id>/set_web_url', methods=['POST'])
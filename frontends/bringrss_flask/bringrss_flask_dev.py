@@ -33,6 +33,7 @@ def bringrss_flask_dev(
         localhost_only,
         init,
         port,
+        refresh_workers,
         use_https,
     ):
     if use_https is None:
@@ -74,7 +75,7 @@ def bringrss_flask_dev(
         message += ' (https)'
     log.info(message)
 
-    backend.common.start_background_threads()
+    backend.common.start_background_threads(refresh_workers=refresh_workers)
 
     try:
         http.serve_forever()
@@ -88,6 +89,7 @@ def bringrss_flask_dev_argparse(args):
         localhost_only=args.localhost_only,
         init=args.init,
         port=args.port,
+        refresh_workers=args.refresh_workers,
         use_https=args.use_https,
     )
 
@@ -146,6 +148,16 @@ def main(argv):
         Other users on the LAN will be blocked.
         ''',
     )
+    parser.add_argument(
+        '--refresh_workers',
+        '--refresh-workers',
+        type=int,
+        default=backend.common.DEFAULT_REFRESH_WORKERS,
+        help='''
+        The number of feeds that can be downloaded at the same time during a
+        refresh. The database writes are still done one feed at a time.
+        ''',
+    )
     parser.set_defaults(func=bringrss_flask_dev_argparse)
 
     return betterhelp.go(parser, argv)
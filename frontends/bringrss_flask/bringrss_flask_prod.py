@@ -20,5 +20,8 @@ if os.environ.get('BRINGRSS_DEMO_MODE', False):
     pipeable.stderr('Setting demo_mode = True')
     site.demo_mode = True
 
+refresh_workers = os.environ.get('BRINGRSS_REFRESH_WORKERS', backend.common.DEFAULT_REFRESH_WORKERS)
+refresh_workers = int(refresh_workers)
+
 backend.common.init_bringdb()
-backend.common.start_background_threads()
+backend.common.start_background_threads(refresh_workers=refresh_workers)
@@ -49,6 +49,26 @@ function refresh_all(callback)
     });
 }
 
+api.feeds.set_adaptive_interval_bounds =
+function set_adaptive_interval_bounds(feed_id, minimum, maximum, callback)
+{
+    return http.post({
+        url: `/feed/${feed_id}/set_adaptive_interval_bounds`,
+        data: {"minimum": minimum, "maximum": maximum},
+        callback: callback,
+    });
+}
+
+api.feeds.set_adaptive_refresh =
+function set_adaptive_refresh(feed_id, adaptive_refresh, callback)
+{
+    return http.post({
+        url: `/feed/${feed_id}/set_adaptive_refresh`,
+        data: {"adaptive_refresh": adaptive_refresh},
+        callback: callback,
+    });
+}
+
 api.feeds.set_autorefresh_interval =
 function set_autorefresh_interval(feed_id, interval, callback)
 {
@@ -264,8 +284,13 @@ function get_and_set_read(news_id, callback)
 }
 
 api.news.get_newss =
-function get_newss(feed_id, read, recycled, callback)
+function get_newss(feed_id, read, recycled, limit, after, callback)
 {
+    /*
+    If limit is null, the response is the list of all the news. Otherwise it
+    is {"newss": [...], "next_cursor": ...}, and the next page can be requested
+    by passing that cursor as `after`. The cursor is null on the last page.
+    */
     let parameters = new URLSearchParams();
     if (read !== null)
     {
@@ -275,6 +300,14 @@ function get_newss(feed_id, read, recycled, callback)
     {
         parameters.set("recycled", recycled);
     }
+    if (limit !== null)
+    {
+        parameters.set("limit", limit);
+    }
+    if (after !== null)
+    {
+        parameters.set("after", after);
+    }
     parameters = parameters.toString();
     if (parameters !== "")
     {
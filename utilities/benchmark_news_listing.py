@@ -0,0 +1,127 @@
+import argparse
+import json
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from voussoirkit import betterhelp
+from voussoirkit import pathclass
+from voussoirkit import pipeable
+from voussoirkit import vlogging
+
+import bringrss
+
+log = vlogging.getLogger(__name__, 'benchmark_news_listing')
+
+def make_bringdb(data_directory, *, news_count, feed_count):
+    bringdb = bringrss.bringdb.BringDB(data_directory, create=True)
+    rng = random.Random(0)
+    with bringdb.transaction:
+        folder = bringdb.add_feed(title='folder')
+        feeds = [bringdb.add_feed(title=f'feed {index}', parent=folder) for index in range(feed_count)]
+        newss = []
+        for index in range(news_count):
+            enclosures = []
+            if index % 3 == 0:
+                enclosures.append({'url': f'https://example.com/{index}.mp3', 'type': 'audio/mpeg'})
+            newss.append({
+                'feed': rng.choice(feeds),
+                'rss_guid': f'https://example.com/{index}',
+                'published': rng.randint(1_000_000_000, 1_700_000_000),
+                'updated': 0,
+                'title': f'News number {index}',
+                # A typical article body, which the listing doesn't need.
+                'text': 'Lorem ipsum dolor sit amet. ' * 150,
+                'web_url': f'https://example.com/{index}',
+                'comments_url': None,
+                'authors': [{'name': 'Author'}],
+                'enclosures': enclosures,
+            })
+        newss = bringdb.add_newss(newss)
+        for news in newss:
+            if rng.random() < 0.8:
+                news.set_read(True)
+    return (bringdb, folder)
+
+def time_function(function, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+def benchmark_news_listing_argparse(args):
+    with tempfile.TemporaryDirectory() as tempdir:
+        pipeable.stderr(f'Creating {args.count} news in {args.feeds} feeds.')
+        (bringdb, folder) = make_bringdb(pathclass.Path(tempdir), news_count=args.count, feed_count=args.feeds)
+
+        cases = [
+            ('unread news of the folder', {'read': False}),
+            ('read and unread news of the folder', {'read': None}),
+            ('first page of 500 read and unread', {'read': None, 'limit': 500}),
+        ]
+        for (description, kwargs) in cases:
+            kwargs['feed'] = folder
+
+            def objects_path():
+                newss = bringdb.get_newss(**kwargs)
+                return json.dumps([news.jsonify() for news in newss])
+
+            def json_path():
+                return bringdb.get_newss_json(**kwargs)[0]
+
+            count = len(json.loads(json_path()))
+            objects_time = time_function(objects_path, args.repeat)
+            json_time = time_function(json_path, args.repeat)
+            pipeable.stdout(
+                f'{description} ({count} news): '
+                f'get_newss + jsonify {objects_time * 1000:.1f} ms, '
+                f'get_newss_json {json_time * 1000:.1f} ms, '
+                f'{objects_time / json_time:.1f}x'
+            )
+
+        bringdb.close()
+    return 0
+
+@vlogging.main_decorator
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='''
+        Compare the time it takes to produce the /news.json listing through
+        News objects and jsonify against the get_newss_json fast path. The news
+        are created in a temporary database, which is deleted afterwards.
+        ''',
+    )
+    parser.add_argument(
+        '--count',
+        type=int,
+        default=50000,
+        help='''
+        Number of news to create.
+        ''',
+    )
+    parser.add_argument(
+        '--feeds',
+        type=int,
+        default=20,
+        help='''
+        Number of feeds in the folder, which the news are spread across.
+        ''',
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help='''
+        Run each listing this many times and report the median.
+        ''',
+    )
+    parser.set_defaults(func=benchmark_news_listing_argparse)
+
+    return betterhelp.go(parser, argv)
+
+if __name__ == '__main__':
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,349 @@
+import argparse
+import re
+import sys
+
+from voussoirkit import betterhelp
+from voussoirkit import pathclass
+from voussoirkit import pipeable
+from voussoirkit import vlogging
+
+import bringrss
+
+log = vlogging.getLogger(__name__, 'database_upgrader')
+
+def checkpoint(bringdb):
+    '''
+    Commit the work so far and begin a new transaction. Upgraders that work in
+    batches call this between batches so the upgrade isn't one giant
+    transaction, which means they must be able to resume from any checkpoint
+    if the upgrade is interrupted, because the version number is only bumped
+    at the very end.
+    '''
+    bringdb.commit()
+    bringdb.begin(transaction_mode='IMMEDIATE')
+
+def upgrade_1_to_2(bringdb):
+    '''
+    In this version, the feeds table gets the http_etag and http_last_modified
+    columns, so that conditional requests no longer depend on an in-memory
+    cache that is lost on restart.
+    '''
+    bringdb.execute('ALTER TABLE feeds ADD COLUMN http_etag TEXT')
+    bringdb.execute('ALTER TABLE feeds ADD COLUMN http_last_modified TEXT')
+
+def upgrade_2_to_3(bringdb):
+    '''
+    In this version, the feeds table gets the last_content_hash column, so
+    that a refresh which downloads the same document as last time can skip
+    parsing and ingesting it.
+    '''
+    bringdb.execute('ALTER TABLE feeds ADD COLUMN last_content_hash TEXT')
+
+def upgrade_3_to_4(bringdb):
+    '''
+    In this version, the feeds table gets the refresh_not_before column, so
+    that the autorefresh can honor the origin's Cache-Control, Expires, and
+    Retry-After headers.
+    '''
+    bringdb.execute('ALTER TABLE feeds ADD COLUMN refresh_not_before INT')
+
+def upgrade_4_to_5(bringdb):
+    '''
+    In this version, the feeds table gets the refresh_failures column, so that
+    failing feeds can back off instead of being retried at full cost forever.
+    '''
+    bringdb.execute('ALTER TABLE feeds ADD COLUMN refresh_failures INT NOT NULL DEFAULT 0')
+
+def upgrade_5_to_6(bringdb):
+    '''
+    In this version, the feeds table gets the adaptive_refresh columns, so
+    that feeds can be refreshed according to how often they publish.
+    '''
+    bringdb.execute('ALTER TABLE feeds ADD COLUMN adaptive_refresh BOOLEAN NOT NULL DEFAULT 0')
+    bringdb.execute('ALTER TABLE feeds ADD COLUMN adaptive_interval_min INT')
+    bringdb.execute('ALTER TABLE feeds ADD COLUMN adaptive_interval_max INT')
+    bringdb.execute('ALTER TABLE feeds ADD COLUMN adaptive_interval INT')
+
+def upgrade_6_to_7(bringdb):
+    '''
+    In this version, the feeds table gets the high_water_guids and
+    last_full_ingest columns, so that refreshes can stop parsing the document
+    once they reach news they've already seen.
+    '''
+    bringdb.execute('ALTER TABLE feeds ADD COLUMN high_water_guids TEXT')
+    bringdb.execute('ALTER TABLE feeds ADD COLUMN last_full_ingest INT')
+
+def upgrade_7_to_8(bringdb):
+    '''
+    In this version, the feeds, filters, and news tables declare their id as
+    INTEGER PRIMARY KEY instead of INT PRIMARY KEY, so that the id is the
+    table's rowid. Previously, each table had a hidden rowid plus the unique
+    index on id, and index_feeds_id and index_news_id duplicated that again.
+
+    SQLite can't change the primary key of an existing table, so each table is
+    renamed out of the way, recreated, and the rows are copied over in
+    batches with progress reports. Each batch is committed on its own, so the
+    journal stays small. If the upgrade is interrupted, the database is left
+    at version 7 and running the upgrader again picks up where it stopped.
+    '''
+    batch_size = 10000
+
+    # With the legacy behavior and foreign keys off, renaming a table does not
+    # rewrite the foreign keys of other tables to point at the renamed table,
+    # so they will point to the new table of the same name.
+    bringdb.pragma_write('legacy_alter_table', 'ON')
+
+    redundant_indices = {'index_feeds_id', 'index_news_id'}
+
+    # The indices are dropped before the copy and recreated after it, which
+    # is faster than updating them row by row. Their sql is kept here so that
+    # it survives an interruption in between.
+    bringdb.execute('''
+    CREATE TABLE IF NOT EXISTS upgrade_7_to_8_indices(
+        name TEXT PRIMARY KEY NOT NULL,
+        tbl_name TEXT NOT NULL,
+        sql TEXT NOT NULL
+    )
+    ''')
+
+    for table in ['feeds', 'filters', 'news']:
+        query = "SELECT 1 FROM sqlite_master WHERE type == 'table' AND name == ?"
+        resuming = bringdb.execute(query, [f'{table}_old']).fetchone() is not None
+
+        if not resuming:
+            query = "SELECT sql FROM sqlite_master WHERE type == 'table' AND name == ?"
+            create = bringdb.execute(query, [table]).fetchone()[0]
+            if re.search(r'\bid INTEGER PRIMARY KEY NOT NULL\b', create):
+                # Finished before an interruption.
+                continue
+
+            (create, count) = re.subn(
+                r'\bid INT PRIMARY KEY NOT NULL\b',
+                'id INTEGER PRIMARY KEY NOT NULL',
+                create,
+            )
+            if count != 1:
+                raise ValueError(f'Did not find the id column of {table}.')
+
+            # The index names have to be freed up for the new table.
+            query = "SELECT name, sql FROM sqlite_master WHERE type == 'index' AND tbl_name == ? AND sql IS NOT NULL"
+            indices = bringdb.execute(query, [table]).fetchall()
+            for (name, sql) in indices:
+                bringdb.execute(
+                    'INSERT INTO upgrade_7_to_8_indices(name, tbl_name, sql) VALUES(?, ?, ?)',
+                    [name, table, sql],
+                )
+                bringdb.execute(f'DROP INDEX {name}')
+
+            bringdb.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+            bringdb.execute(create)
+            checkpoint(bringdb)
+
+        total = bringdb.execute(f'SELECT COUNT(*) FROM {table}_old').fetchone()[0]
+        copied = bringdb.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        while True:
+            last_id = bringdb.execute(f'SELECT MAX(id) FROM {table}').fetchone()[0]
+            if last_id is None:
+                query = f'INSERT INTO {table} SELECT * FROM {table}_old ORDER BY id LIMIT ?'
+                bindings = [batch_size]
+            else:
+                query = f'INSERT INTO {table} SELECT * FROM {table}_old WHERE id > ? ORDER BY id LIMIT ?'
+                bindings = [last_id, batch_size]
+
+            cur = bringdb.execute(query, bindings)
+            if cur.rowcount < 1:
+                break
+
+            checkpoint(bringdb)
+            copied += cur.rowcount
+            pipeable.stderr(f'Copied {copied} / {total} {table}.')
+
+        bringdb.execute(f'DROP TABLE {table}_old')
+
+        query = 'SELECT name, sql FROM upgrade_7_to_8_indices WHERE tbl_name == ?'
+        indices = bringdb.execute(query, [table]).fetchall()
+        for (name, sql) in indices:
+            if name in redundant_indices:
+                continue
+            pipeable.stderr(f'Creating {name}.')
+            bringdb.execute(sql)
+        bringdb.execute('DELETE FROM upgrade_7_to_8_indices WHERE tbl_name == ?', [table])
+        checkpoint(bringdb)
+
+    bringdb.execute('DROP TABLE upgrade_7_to_8_indices')
+    bringdb.pragma_write('legacy_alter_table', 'OFF')
+
+def upgrade_8_to_9(bringdb):
+    '''
+    In this version, the news indices are redesigned around the queries that
+    get_newss and the unread counts actually perform. The composite indices
+    that started with recycled, read made a small feed's listing scan all of
+    the unread news, so they are replaced by feed-first indices and partial
+    indices of the unread and recycled news.
+    '''
+    bringdb.execute('DROP INDEX IF EXISTS index_news_feed_id')
+    bringdb.execute('DROP INDEX IF EXISTS index_news_recycled_read_published_feed_id')
+    bringdb.execute('DROP INDEX IF EXISTS index_news_recycled_published_feed_id')
+    # See the note in constants.DB_INIT about the order.
+    bringdb.execute('CREATE INDEX index_news_feed_id_published on news(feed_id, published)')
+    bringdb.execute('CREATE INDEX index_news_unrecycled_published on news(published) WHERE recycled == 0')
+    bringdb.execute('CREATE INDEX index_news_recycled_published on news(published) WHERE recycled == 1')
+    bringdb.execute('CREATE INDEX index_news_unread_feed_id_published on news(feed_id, published) WHERE recycled == 0 AND read == 0')
+    bringdb.execute('CREATE INDEX index_news_unread_published on news(published) WHERE recycled == 0 AND read == 0')
+
+def upgrade_9_to_10(bringdb):
+    '''
+    In this version, the news table gets the guid_hash column, a 64-bit hash
+    of the rss_guid. Duplicate detection looks up the hash instead of the
+    text, so the big index on rss_guid is replaced by a small one on
+    guid_hash.
+
+    The guids are hashed in batches, each committed on its own. If the upgrade
+    is interrupted, the database is left at version 9 and running the
+    upgrader again continues with the rows that are still unhashed.
+    '''
+    batch_size = 10000
+
+    columns = [row[1] for row in bringdb.execute('PRAGMA table_info(news)')]
+    if 'guid_hash' not in columns:
+        bringdb.execute('ALTER TABLE news ADD COLUMN guid_hash INT NOT NULL DEFAULT 0')
+        checkpoint(bringdb)
+
+    # hash_guid is registered on the connection by BringDB. The column
+    # defaults to 0, so we resume from the first row that still has it. A guid
+    # whose real hash is 0 only means some rows get hashed a second time.
+    total = bringdb.execute('SELECT COUNT(*) FROM news').fetchone()[0]
+    last_id = bringdb.execute('SELECT MIN(id) FROM news WHERE guid_hash == 0').fetchone()[0]
+    if last_id is not None:
+        last_id -= 1
+        done = bringdb.execute('SELECT COUNT(*) FROM news WHERE id <= ?', [last_id]).fetchone()[0]
+    while last_id is not None:
+        query = 'SELECT id FROM news WHERE id > ? ORDER BY id LIMIT 1 OFFSET ?'
+        boundary = bringdb.execute(query, [last_id, batch_size - 1]).fetchone()
+        if boundary is None:
+            query = 'UPDATE news SET guid_hash = hash_guid(rss_guid) WHERE id > ?'
+            bringdb.execute(query, [last_id])
+            last_id = None
+        else:
+            query = 'UPDATE news SET guid_hash = hash_guid(rss_guid) WHERE id > ? AND id <= ?'
+            bringdb.execute(query, [last_id, boundary[0]])
+            last_id = boundary[0]
+        checkpoint(bringdb)
+        if last_id is not None:
+            done += batch_size
+            pipeable.stderr(f'Hashed {done} / {total} guids.')
+
+    bringdb.execute('CREATE INDEX index_news_guid_hash on news(guid_hash)')
+    bringdb.execute('DROP INDEX IF EXISTS index_news_guid')
+
+def upgrade_10_to_11(bringdb):
+    '''
+    In this version, the unread count of each feed is stored in the new
+    feed_unread_counts table instead of being counted from the news table
+    every time.
+    '''
+    bringdb.execute('''
+    CREATE TABLE feed_unread_counts(
+        feed_id INTEGER PRIMARY KEY NOT NULL,
+        unread INT NOT NULL,
+        FOREIGN KEY(feed_id) REFERENCES feeds(id)
+    )
+    ''')
+    bringdb.execute('''
+    INSERT INTO feed_unread_counts(feed_id, unread)
+    SELECT feed_id, COUNT(rowid)
+    FROM news
+    WHERE recycled == 0 AND read == 0
+    GROUP BY feed_id
+    ''')
+
+def upgrade_11_to_12(bringdb):
+    '''
+    In this version, the largest id given out in each table is stored in the
+    new id_counters table, so that the ids of deleted rows are not reused.
+    '''
+    bringdb.execute('''
+    CREATE TABLE id_counters(
+        table_name TEXT PRIMARY KEY NOT NULL,
+        last_id INT NOT NULL
+    )
+    ''')
+    for table in ['feeds', 'filters', 'news']:
+        bringdb.execute(
+            f'INSERT INTO id_counters(table_name, last_id) SELECT ?, COALESCE(MAX(id), 0) FROM {table}',
+            [table],
+        )
+
+def upgrade_12_to_13(bringdb):
+    '''
+    In this version, the original_feed_id index also covers published, so that
+    the adaptive intervals can count each feed's recent news without scanning
+    the whole news table.
+    '''
+    bringdb.execute('CREATE INDEX index_news_original_feed_id_published on news(original_feed_id, published)')
+    bringdb.execute('DROP INDEX IF EXISTS index_news_original_feed_id')
+
+def upgrade_all(data_directory):
+    '''
+    Given the directory containing a bringdb database, apply all of the
+    needed upgrade_x_to_y functions in order.
+    '''
+    data_directory = pathclass.Path(data_directory)
+    bringdb = bringrss.bringdb.BringDB(data_directory, skip_version_check=True)
+
+    current_version = bringdb.pragma_read('user_version')
+    needed_version = bringrss.constants.DATABASE_VERSION
+
+    if current_version == needed_version:
+        pipeable.stderr(f'Already up to date with version {needed_version}.')
+        bringdb.close()
+        return 0
+
+    for version_number in range(current_version + 1, needed_version + 1):
+        pipeable.stderr(f'Upgrading from {current_version} to {version_number}.')
+        upgrade_function = f'upgrade_{current_version}_to_{version_number}'
+        upgrade_function = globals()[upgrade_function]
+
+        # Pragma foreign_keys can't be changed during a transaction. They are
+        # off so that upgraders can rebuild tables without the drops cascading
+        # into other tables, and we check them ourselves before committing.
+        bringdb.pragma_write('foreign_keys', 'OFF')
+        with bringdb.transaction:
+            upgrade_function(bringdb)
+            violations = bringdb.execute('PRAGMA foreign_key_check').fetchall()
+            if violations:
+                raise Exception(f'Upgrading to {version_number} broke foreign keys: {violations}')
+            bringdb.pragma_write('user_version', version_number)
+
+        current_version = version_number
+
+    bringdb.close()
+    pipeable.stderr('Upgrades finished.')
+    return 0
+
+def upgrade_all_argparse(args):
+    return upgrade_all(data_directory=args.data_directory)
+
+@vlogging.main_decorator
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='''
+        Upgrade your BringRSS database to the version expected by this copy of
+        the code. You should make a backup of your database first.
+
+        Long upgrades commit their progress in batches. If one is interrupted,
+        run the upgrader again to continue.
+        ''',
+    )
+    parser.add_argument(
+        'data_directory',
+        help='''
+        Filepath to the _bringrss data directory.
+        ''',
+    )
+    parser.set_defaults(func=upgrade_all_argparse)
+
+    return betterhelp.go(parser, argv)
+
+if __name__ == '__main__':
+    raise SystemExit(main(sys.argv[1:]))
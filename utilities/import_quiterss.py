@@ -149,8 +149,10 @@ def import_quiterss(feedsdb, bringdb):
     WHERE deleted == 0;
     '''
     newss = list(quite_sql.execute(query))
+    new_newss = []
+    read_flags = []
     for news in newss:
-        quite_read = news['read']
+        read_flags.append(news['read'] > 0)
 
         authors = [{
             'name': news['author_name'],
@@ -163,19 +165,22 @@ def import_quiterss(feedsdb, bringdb):
             'size': int(news['enclosure_length']) if news.get('enclosure_length') else None
         }]
 
-        news = bringdb.add_news(
-            authors=authors,
-            comments_url=news['comments'],
-            enclosures=enclosures,
-            feed=feed_id_map[news['feedId']],
-            published=news['published'],
-            rss_guid=news['guid'],
-            text=news['description'],
-            title=news['title'],
-            updated=news['modified'] or news['published'],
-            web_url=news['link_href'],
-        )
-        if quite_read > 0:
+        new_newss.append({
+            'authors': authors,
+            'comments_url': news['comments'],
+            'enclosures': enclosures,
+            'feed': feed_id_map[news['feedId']],
+            'published': news['published'],
+            'rss_guid': news['guid'],
+            'text': news['description'],
+            'title': news['title'],
+            'updated': news['modified'] or news['published'],
+            'web_url': news['link_href'],
+        })
+
+    newss = bringdb.add_newss(new_newss)
+    for (news, read) in zip(newss, read_flags):
+        if read:
             news.set_read(True)
 
 @vlogging.main_decorator
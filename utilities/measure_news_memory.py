@@ -0,0 +1,108 @@
+import argparse
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from voussoirkit import betterhelp
+from voussoirkit import pathclass
+from voussoirkit import pipeable
+from voussoirkit import vlogging
+
+import bringrss
+
+log = vlogging.getLogger(__name__, 'measure_news_memory')
+
+def make_news(data_directory, *, news_count, text_length):
+    bringdb = bringrss.bringdb.BringDB(data_directory, create=True)
+    rng = random.Random(0)
+    with bringdb.transaction:
+        feed = bringdb.add_feed(title='feed')
+        newss = []
+        for index in range(news_count):
+            newss.append({
+                'feed': feed,
+                'rss_guid': f'https://example.com/{index}',
+                'published': rng.randint(1_000_000_000, 1_700_000_000),
+                'updated': 0,
+                'title': f'News number {index}',
+                'text': ('Lorem ipsum dolor sit amet. ' * text_length)[:text_length],
+                'web_url': f'https://example.com/{index}',
+                'comments_url': None,
+                'authors': [{'name': 'Author', 'email': 'author@example.com'}],
+                'enclosures': [{'url': f'https://example.com/{index}.mp3', 'type': 'audio/mpeg'}],
+            })
+        bringdb.add_newss(newss)
+    bringdb.close()
+
+def measure_news_memory_argparse(args):
+    with tempfile.TemporaryDirectory() as tempdir:
+        data_directory = pathclass.Path(tempdir)
+        pipeable.stderr(f'Creating {args.count} news with {args.text_length} characters of text.')
+        make_news(data_directory, news_count=args.count, text_length=args.text_length)
+
+        # A fresh BringDB so that the cache starts out empty.
+        bringdb = bringrss.bringdb.BringDB(data_directory)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        newss = list(bringdb.get_newss(read=None))
+        duration = time.perf_counter() - start
+        (current, peak) = tracemalloc.get_traced_memory()
+        pipeable.stdout(
+            f'Loaded {len(newss)} news in {duration * 1000:.1f} ms. '
+            f'{current / len(newss):.0f} bytes per news, '
+            f'{current / 2**20:.1f} MiB in total, '
+            f'{peak / 2**20:.1f} MiB peak.'
+        )
+
+        # Access the fields that the listing and the filters use, so that the
+        # cost of loading them later is visible too.
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        for news in newss:
+            (news.title, news.published_string_local, news.enclosures)
+        duration = time.perf_counter() - start
+        (current, peak) = tracemalloc.get_traced_memory()
+        pipeable.stdout(
+            f'Accessed title, published, and enclosures in {duration * 1000:.1f} ms. '
+            f'{current / len(newss):.0f} bytes per news.'
+        )
+        tracemalloc.stop()
+
+        bringdb.close()
+    return 0
+
+@vlogging.main_decorator
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='''
+        Measure how much memory the News objects take up when a listing fills
+        the cache. The news are created in a temporary database, which is
+        deleted afterwards.
+        ''',
+    )
+    parser.add_argument(
+        '--count',
+        type=int,
+        default=20000,
+        help='''
+        Number of news to create. The default is the size of the News cache.
+        ''',
+    )
+    parser.add_argument(
+        '--text_length',
+        '--text-length',
+        type=int,
+        default=5000,
+        help='''
+        Number of characters of text in each news.
+        ''',
+    )
+    parser.set_defaults(func=measure_news_memory_argparse)
+
+    return betterhelp.go(parser, argv)
+
+if __name__ == '__main__':
+    raise SystemExit(main(sys.argv[1:]))